@@ -0,0 +1,97 @@
+from PIL import Image
+from deep_zoom import DeepZoomWriter, TILE_SIZE
+from instrument import stats
+from stream_png import png_writer
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    np = None
+
+
+# Poster canvas held as a height x width x 3 array, a drop in for PosterImage when rendering.
+# Covers passed to add_image are held back and written a batch at a time: all the covers of one size go in
+# with a single indexed assignment rather than one paste each. With file the array is an np.memmap of that
+# file, so the canvas can be bigger than memory. Needs numpy, which PosterImage does not
+class ArrayCanvas:
+
+    def __init__(self, width, height, left_margin, top_margin, file: str = None, batch_size=256):
+        assert np is not None, "ArrayCanvas needs numpy, use PosterImage without it"
+        self.width = width
+        self.height = height
+        self.left_margin = left_margin
+        self.top_margin = top_margin
+        self.batch_size = batch_size
+        self.pending = {}  # Cover px -> [(image, x, y)] not yet written
+
+        if file is None:
+            self.array = np.full((height, width, 3), 255, np.uint8)
+        else:
+            self.array = np.memmap(file, np.uint8, "w+", shape=(height, width, 3))
+            for y in range(0, height, TILE_SIZE):
+                self.array[y:y + TILE_SIZE] = 255
+
+    def add_image(self, image: Image, x_pos: float, y_pos: float):
+        if image.width != image.height:
+            self.flush()
+            self.paste(image, x_pos + self.left_margin, y_pos + self.top_margin)
+            return
+
+        batch = self.pending.setdefault(image.width, [])
+        batch.append((image, x_pos + self.left_margin, y_pos + self.top_margin))
+        if len(batch) >= self.batch_size:
+            self._write_batch(image.width, batch)
+            del self.pending[image.width]
+
+    def _write_batch(self, px, batch):
+        with stats.span("paste"):
+            tiles = np.empty((len(batch), px, px, 3), np.uint8)
+            for i, (image, _, _) in enumerate(batch):
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+                tiles[i] = np.frombuffer(image.tobytes(), np.uint8).reshape(px, px, 3)
+            # windows[y, x] is a (3, px, px) view of the canvas with its top left corner at (x, y), so the whole
+            # batch is written with one strided assignment
+            windows = sliding_window_view(self.array, (px, px), axis=(0, 1), writeable=True)
+            windows[[y for _, _, y in batch], [x for _, x, _ in batch]] = tiles.transpose(0, 3, 1, 2)
+
+    def flush(self):
+        for px, batch in self.pending.items():
+            self._write_batch(px, batch)
+        self.pending = {}
+
+    def paste(self, image: Image, x, y):
+        # Position on the canvas, ignoring the margins
+        with stats.span("paste"):
+            self.array[y:y + image.height, x:x + image.width] = np.asarray(image.convert("RGB"))
+
+    def strips(self, strip_height=TILE_SIZE, safety_px=0):
+        # The canvas as RGB images of strip_height rows, with a white border of safety_px all round
+        self.flush()
+        out_width = self.width + safety_px * 2
+        out_height = self.height + safety_px * 2
+        for out_start in range(0, out_height, strip_height):
+            out_end = min(out_start + strip_height, out_height)
+            strip = Image.new("RGB", (out_width, out_end - out_start), "white")
+            y_start = max(0, out_start - safety_px)
+            y_end = min(self.height, out_end - safety_px)
+            if y_start < y_end:
+                strip.paste(Image.fromarray(self.array[y_start:y_end]), (safety_px, y_start + safety_px - out_start))
+            yield strip
+
+    def save(self, file="out.png", safety_px=0, compress_level=6, processes=1):
+        # Encoded a strip at a time, so a memmapped canvas is never read into memory all at once
+        with stats.span("save"), png_writer(file, self.width + safety_px * 2, self.height + safety_px * 2,
+                                            compress_level, processes) as writer:
+            for strip in self.strips(safety_px=safety_px):
+                writer.write_strip(strip)
+
+    def save_deep_zoom(self, file="out.dzi", processes=None):
+        with stats.span("deep zoom"), DeepZoomWriter(file, self.width, self.height, processes=processes) as writer:
+            for strip in self.strips():
+                writer.write_strip(strip)
+
+    def to_image(self) -> Image:
+        self.flush()
+        return Image.fromarray(self.array)
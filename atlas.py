@@ -0,0 +1,206 @@
+from PIL import Image
+import mmap
+import os
+import struct
+import sys
+
+# Every cover in an artwork directory packed into one file, so rendering reads pixels straight out of an mmap
+# instead of listing, opening and decoding thousands of files:
+#   header  magic, version, tile px of the largest level, number of levels, number of tiles
+#   index   for each tile, its album id's utf-8 length (u16) then the bytes, then the modification time of
+#           the file it was packed from (ns, i64) and its mean colour (3 bytes)
+#   levels  from DATA_ALIGN, for each level (tile px, then half that and so on) every tile in index order
+# Pixels are stored RGBX rather than RGB so PIL can use the mapped bytes as an image without copying them.
+# That makes the atlas much bigger than the PNGs: with the defaults each cover takes
+# 640 * 640 * 4 * (1 + 1/4 + 1/16 + 1/64) bytes, about 2.2 MB, so 10,000 covers is about 22 GB.
+# image.main packs it at the px of the poster's largest square instead (dim * 4, e.g. 240 px and about
+# 3 GB for 10,000 covers), where the size 1, 2 and 4 squares each come straight from a level
+MAGIC = b"MPAT"
+VERSION = 2
+HEADER = struct.Struct("<4sHIII")
+ID_LENGTH = struct.Struct("<H")
+MTIME = struct.Struct("<q")
+MEAN = struct.Struct("<BBB")
+DATA_ALIGN = 4096
+TILE_PX = 640  # Spotify's largest covers
+NUM_LEVELS = 4
+
+
+def level_px(tile_px, level):
+    return tile_px >> level
+
+
+def tile_bytes(px):
+    return px * px * 4
+
+
+def open_previous(file: str, tile_px, num_levels):
+    # The atlas an earlier build left, if its tiles can be reused
+    if not os.path.exists(file):
+        return None
+    try:
+        previous = Atlas(file)
+    except ValueError:
+        return None
+    if (previous.tile_px, previous.num_levels) != (tile_px, num_levels):
+        previous.close()
+        return None
+    return previous
+
+
+# Only covers that are new or whose file changed since the atlas at file was built are decoded, the others are
+# copied across from it. If nothing changed the atlas is left as it is. Returns the number of covers decoded
+def build_atlas(base_dir: str, file: str, tile_px=TILE_PX, num_levels=NUM_LEVELS):
+    assert level_px(tile_px, num_levels - 1) > 0
+    mtimes = {}
+    for entry in os.scandir(base_dir):
+        if entry.name.endswith(".png"):
+            mtimes[entry.name[:-len(".png")]] = entry.stat().st_mtime_ns
+    aids = list(mtimes)
+
+    previous = open_previous(file, tile_px, num_levels)
+    reuse = set()
+    if previous is not None:
+        reuse = {aid for aid in aids if aid in previous and previous.mtime(aid) == mtimes[aid]}
+        if len(reuse) == len(aids) == len(previous.tiles):
+            previous.close()
+            return 0
+
+    index = [HEADER.pack(MAGIC, VERSION, tile_px, num_levels, len(aids))]
+    for aid in aids:
+        encoded = aid.encode("utf-8")
+        index.append(ID_LENGTH.pack(len(encoded)))
+        index.append(encoded)
+        index.append(MTIME.pack(mtimes[aid]))
+        index.append(MEAN.pack(0, 0, 0))  # Filled in as the covers are packed
+    index_size = sum(len(part) for part in index)
+    data_offset = -(-index_size // DATA_ALIGN) * DATA_ALIGN
+
+    level_offsets = [data_offset]
+    for level in range(num_levels - 1):
+        level_offsets.append(level_offsets[-1] + len(aids) * tile_bytes(level_px(tile_px, level)))
+
+    tmp_file = f"{file}.tmp"
+    decoded = 0
+    with open(tmp_file, "wb") as f:
+        f.write(b"".join(index))
+        means = []
+        for i, aid in enumerate(aids):
+            if aid in reuse:
+                for level in range(num_levels):
+                    f.seek(level_offsets[level] + i * tile_bytes(level_px(tile_px, level)))
+                    f.write(previous.level_bytes(aid, level))
+                means.append(previous.mean_colour(aid))
+                continue
+
+            with Image.open(f"{base_dir}/{aid}.png") as cover:
+                tile = cover.convert("RGB").resize((tile_px, tile_px), Image.LANCZOS)
+
+            for level in range(num_levels):
+                if level > 0:
+                    tile = tile.resize((level_px(tile_px, level), level_px(tile_px, level)), Image.BOX)
+                f.seek(level_offsets[level] + i * tile_bytes(level_px(tile_px, level)))
+                f.write(tile.convert("RGBX").tobytes())
+            means.append(tile.resize((1, 1), Image.BOX).getpixel((0, 0)))
+
+            decoded += 1
+            if decoded % 100 == 0:
+                print(f"Packing artwork [{int(100 * decoded / (len(aids) - len(reuse)))}%]")
+
+        # Now the means are known
+        offset = HEADER.size
+        for aid, mean in zip(aids, means):
+            offset += ID_LENGTH.size + len(aid.encode("utf-8")) + MTIME.size
+            f.seek(offset)
+            f.write(MEAN.pack(*mean))
+            offset += MEAN.size
+
+    if previous is not None:
+        previous.close()
+    os.replace(tmp_file, file)
+    return decoded
+
+
+class Atlas:
+
+    def __init__(self, file: str):
+        self.file = file
+        self.f = open(file, "rb")
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.tile_px, self.num_levels, num_tiles = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file} is not a version {VERSION} artwork atlas")
+
+        self.tiles = {}  # Album id -> tile number
+        self.mtimes = []
+        self.means = []
+        offset = HEADER.size
+        for i in range(num_tiles):
+            length, = ID_LENGTH.unpack_from(self.data, offset)
+            offset += ID_LENGTH.size
+            self.tiles[self.data[offset:offset + length].decode("utf-8")] = i
+            offset += length
+            self.mtimes.append(MTIME.unpack_from(self.data, offset)[0])
+            offset += MTIME.size
+            self.means.append(MEAN.unpack_from(self.data, offset))
+            offset += MEAN.size
+
+        self.level_offsets = [-(-offset // DATA_ALIGN) * DATA_ALIGN]
+        for level in range(self.num_levels - 1):
+            self.level_offsets.append(self.level_offsets[-1] + num_tiles * tile_bytes(level_px(self.tile_px, level)))
+
+    # Render workers open the atlas again rather than being sent it
+    def __getstate__(self):
+        return {"file": self.file}
+
+    def __setstate__(self, state):
+        self.__init__(state["file"])
+
+    def __contains__(self, aid):
+        return aid in self.tiles
+
+    def files(self):
+        # Named like the files the atlas was built from, so it can stand in for listing the directory
+        return [f"{aid}.png" for aid in self.tiles]
+
+    def mean_colour(self, aid: str):
+        return self.means[self.tiles[aid]]
+
+    def mtime(self, aid: str):
+        # Modification time in ns of the file the tile was packed from
+        return self.mtimes[self.tiles[aid]]
+
+    # level_bytes and level are views of the mapped file, valid until close. Copy them to keep the pixels
+    def level_bytes(self, aid: str, level: int):
+        px = level_px(self.tile_px, level)
+        start = self.level_offsets[level] + self.tiles[aid] * tile_bytes(px)
+        return memoryview(self.data)[start:start + tile_bytes(px)]
+
+    def level(self, aid: str, level: int) -> Image:
+        # The tile as an image over the mapped bytes, nothing is copied. It is read only
+        px = level_px(self.tile_px, level)
+        return Image.frombuffer("RGBX", (px, px), self.level_bytes(aid, level), "raw", "RGBX", 0, 1)
+
+    def artwork(self, aid: str, px: int, resample=Image.LANCZOS) -> Image:
+        # Resampled from the smallest level at least px across, so large levels are only read for large squares
+        level = 0
+        while level + 1 < self.num_levels and level_px(self.tile_px, level + 1) >= px:
+            level += 1
+
+        tile = self.level(aid, level)
+        if tile.width == px:
+            return tile.copy()  # Not a view, so it outlives the atlas
+        return tile.resize((px, px), resample)
+
+    def close(self):
+        try:
+            self.data.close()
+        except BufferError:
+            # Views are still alive, the mapping goes once they are freed
+            pass
+        self.f.close()
+
+
+if __name__ == "__main__":
+    ext = sys.argv[1] if len(sys.argv) > 1 else ""
+    print(f"Packed {build_atlas(f'artwork{ext}', f'artwork{ext}.atlas')} new or changed covers")
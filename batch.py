@@ -0,0 +1,157 @@
+# Renders many posters in one go from a job manifest, e.g. one per year or per canvas format:
+#
+#   python batch.py jobs.json
+#
+# where jobs.json looks like
+#
+#   {
+#     "defaults": {"canvas_width": 14043, "canvas_height": 9933, "safety_px": 165},
+#     "jobs": [
+#       {"name": "2018", "history_start": "2018-01-01", "history_end": "2019-01-01"},
+#       {"name": "all-a3", "canvas_width": 4961, "canvas_height": 3508, "safety_px": 0}
+#     ]
+#   }
+#
+# Each job takes the keys in DEFAULTS, any it leaves out come from "defaults" then DEFAULTS. The history is
+# parsed once and each distinct date range and artwork directory is counted or listed once, in this process.
+# Jobs then run on a process pool, biggest canvas first, and share resized artwork through the tile cache
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import history
+import image
+from compute import compute_settings, save_settings
+from instrument import stats, QUIET, PROGRESS
+from tile_cache import TileCache
+
+DEFAULTS = {
+    "name": None,  # Output files are <out_dir>/<name>.png, <name>-safe.png and so on
+    "out_dir": "batch",
+    "base_dir": "artwork",
+    "history_start": None,  # ISO dates, the range is [start, end)
+    "history_end": None,
+    "canvas_width": 14043,
+    "canvas_height": 9933,
+    "safety_px": 165,
+    "engine": "random",
+    "seed": 0,
+    "deep_zoom": False,
+}
+
+
+def read_manifest(file: str):
+    with open(file) as f:
+        manifest = json.load(f)
+
+    defaults = dict(DEFAULTS)
+    defaults.update(manifest.get("defaults", {}))
+    jobs = []
+    for spec in manifest["jobs"]:
+        job = dict(defaults)
+        job.update(spec)
+        assert job["name"] is not None, f"Job {spec} has no name"
+        unknown = set(job) - set(DEFAULTS)
+        assert len(unknown) == 0, f"Job {job['name']} has unknown keys {unknown}"
+        jobs.append(job)
+
+    names = [job["name"] for job in jobs]
+    assert len(names) == len(set(names)), "Job names must be unique"
+    return jobs
+
+
+def parse_date(text):
+    return None if text is None else history.parse_timestamp(text)
+
+
+def init_worker():
+    # Progress from several jobs at once would be interleaved, the batch reports each job as it finishes
+    stats.verbosity = QUIET
+
+
+def run_job(job):
+    spec, freq, files, tile_cache_dir = job
+    stats.reset()
+    start = time.perf_counter()
+    out = os.path.join(spec["out_dir"], spec["name"])
+
+    try:
+        brackets = image.get_brackets(freq)
+        posters, sizes = image.group_posters(files, freq, brackets)
+        settings = compute_settings(len(files), spec["canvas_width"], spec["canvas_height"], sizes)
+        random.seed(spec["seed"])
+        placement = image.do_allocation(settings, posters, engine=image.ENGINES[spec["engine"]]())
+    except image.AllocationFailed as e:
+        return spec["name"], f"failed: {e}", time.perf_counter() - start, stats.to_dict()
+
+    placement.save_binary(f"{out}.bin")
+    save_settings(settings, f"{out}.bin.settings")
+
+    # Jobs already keep every core busy, so each renders serially
+    tile_cache = None if tile_cache_dir is None else TileCache(tile_cache_dir)
+    poster_image = image.PosterImage(spec["canvas_width"], spec["canvas_height"], int(settings.right_margin_px / 2),
+                                     int(settings.bottom_margin_px / 2))
+    image.render_serial(placement, settings, spec["base_dir"], poster_image, tile_cache)
+    poster_image.save(f"{out}.png")
+    if spec["safety_px"] > 0:
+        poster_image.save(f"{out}-safe.png", spec["safety_px"])
+    if spec["deep_zoom"]:
+        # Pool workers can't start a pool of their own
+        poster_image.save_deep_zoom(f"{out}.dzi", processes=0)
+
+    return spec["name"], "done", time.perf_counter() - start, stats.to_dict()
+
+
+def run_batch(jobs, processes=None, tile_cache_dir="tile-cache"):
+    store = history.HistoryStore.load()
+
+    freqs = {}
+    files = {}
+    work = []
+    for spec in jobs:
+        date_range = (spec["history_start"], spec["history_end"])
+        if date_range not in freqs:
+            freqs[date_range] = store.album_counts(parse_date(date_range[0]), parse_date(date_range[1]))
+        if spec["base_dir"] not in files:
+            files[spec["base_dir"]] = image.get_files(spec["base_dir"])
+        job_files = files[spec["base_dir"]]
+        if date_range != (None, None):
+            job_files = image.played_files(job_files, freqs[date_range])
+        os.makedirs(spec["out_dir"], exist_ok=True)
+        work.append((spec, freqs[date_range], job_files, tile_cache_dir))
+
+    # Longest first so a big job isn't left running alone at the end
+    work.sort(key=lambda job: -job[0]["canvas_width"] * job[0]["canvas_height"])
+
+    results = {}
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        for name, status, seconds, job_stats in pool.imap_unordered(run_job, work):
+            stats.merge(job_stats)
+            results[name] = status
+            stats.log(PROGRESS, f"[{len(results)}/{len(work)}] {name} {status} in {seconds:.1f}s")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the posters described by a job manifest")
+    parser.add_argument("manifest")
+    parser.add_argument("--processes", type=int, default=None, help="Defaults to the number of cores")
+    parser.add_argument("--tile-cache", default="tile-cache", help="Shared resized artwork, 'none' to disable")
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest)
+    results = run_batch(jobs, args.processes, None if args.tile_cache == "none" else args.tile_cache)
+    stats.save("batch-stats.json")
+    if stats.enabled(PROGRESS):
+        stats.report()
+
+    if any(status != "done" for status in results.values()):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# Benchmarks for each stage of poster generation on synthetic data, so they can run without a Spotify export.
+#
+#   python bench.py --albums 500 2000 5000 --out bench.json
+#   python bench.py --albums 500 2000 5000 --out bench-new.json --compare bench.json
+#
+# Peak memory is the tracemalloc peak, which covers Python objects but not pixel buffers allocated by PIL,
+# plus the process max RSS after the stage (which only ever goes up over a run). tracemalloc slows Python code
+# down several times over, so each stage is run twice: once timed and once traced.
+from PIL import Image
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import history
+import image
+from compute import compute_settings
+
+POSTER_ASPECT = 14043 / 9933
+STAGES = ["ingest", "frequency", "settings", "allocate", "render"]
+
+
+def album_ids(num_albums: int):
+    return [f"album{i:06d}" for i in range(num_albums)]
+
+
+def make_frequencies(num_albums: int, seed=0):
+    # Zipf-like play counts, a few albums played a lot and a long tail played a handful of times
+    rng = random.Random(seed)
+    freq = {}
+    for rank, aid in enumerate(album_ids(num_albums)):
+        freq[aid] = max(1, int(2000 / (rank + 1) ** 0.9 * rng.uniform(0.8, 1.2)))
+    return freq
+
+
+def make_history(file: str, freq, seed=0):
+    # Writes a tracks.json in the export's one-object-per-line format, returns the number of plays
+    rng = random.Random(seed)
+    start = datetime.datetime(2016, 1, 1)
+    span = 3 * 365 * 86400
+    plays = 0
+    with open(file, "w") as f:
+        for aid, count in freq.items():
+            for i in range(count):
+                played_at = start + datetime.timedelta(seconds=rng.randrange(span), milliseconds=rng.randrange(1000))
+                f.write(json.dumps({
+                    "played_at": {"$date": played_at.isoformat(timespec="milliseconds") + "Z"},
+                    "track": {
+                        "id": f"{aid}-track{i % 12}",
+                        "name": f"Track {i % 12}",
+                        "artists": [{"id": f"artist{zlib.crc32(aid.encode()) % 997}", "name": "Artist"}],
+                        "album": {"id": aid, "name": f"Album {aid}"},
+                    },
+                }) + "\n")
+                plays += 1
+
+    return plays
+
+
+def make_artwork(directory: str, aids, px=64, kind="noise", seed=0):
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    for aid in aids:
+        if kind == "solid":
+            cover = Image.new("RGB", (px, px), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        else:
+            cover = Image.effect_noise((px, px), rng.randint(10, 100)).convert("RGB")
+        cover.save(os.path.join(directory, f"{aid}.png"))
+
+
+def canvas_for(num_cells: int, dim=24):
+    # Canvas with the poster's aspect ratio that fits num_cells squares of about dim px
+    area = num_cells * dim * dim * 1.05
+    height = int(math.sqrt(area / POSTER_ASPECT))
+    return int(height * POSTER_ASPECT), height
+
+
+def max_rss_bytes():
+    # ru_maxrss is in KiB on Linux but bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def measure(fn, setup=None):
+    # setup, if given, runs before each pass to undo what the other pass left behind, e.g. a cache it wrote.
+    # The result is the timed pass's
+    with contextlib.redirect_stdout(io.StringIO()):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - start
+
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, seconds, peak, max_rss_bytes()
+
+
+def remove_file(file: str):
+    if os.path.exists(file):
+        os.remove(file)
+
+
+def bench_albums(num_albums: int, work_dir: str, stages, seed=0):
+    results = []
+
+    def record(stage, seconds, peak, max_rss, items, unit):
+        results.append({
+            "stage": stage,
+            "albums": num_albums,
+            "seconds": seconds,
+            "items": items,
+            "throughput": items / seconds if seconds > 0 else None,
+            "unit": unit,
+            "peak_python_mb": peak / 1e6,
+            "max_rss_mb": max_rss / 1e6,
+        })
+        print(f"{stage:>10} {num_albums:>7} albums  {seconds:8.3f}s  {items / max(seconds, 1e-9):12.1f} {unit}/s")
+
+    random.seed(seed)
+    freq = make_frequencies(num_albums, seed)
+    tracks_file = os.path.join(work_dir, "tracks.json")
+    num_plays = make_history(tracks_file, freq, seed)
+
+    if "ingest" in stages:
+        cache_file = os.path.join(work_dir, "tracks.json.cache")
+        _, seconds, peak, rss = measure(lambda: history.load_plays(tracks_file, cache_file),
+                                        lambda: remove_file(cache_file))
+        record("ingest", seconds, peak, rss, num_plays, "plays")
+        _, seconds, peak, rss = measure(lambda: history.load_plays(tracks_file, cache_file))
+        record("ingest-warm", seconds, peak, rss, num_plays, "plays")
+        store_file = f"{tracks_file}.store"
+        _, seconds, peak, rss = measure(lambda: history.HistoryStore.load(tracks_file, store_file),
+                                        lambda: remove_file(store_file))
+        record("store", seconds, peak, rss, num_plays, "plays")
+        _, seconds, peak, rss = measure(lambda: history.HistoryStore.load(tracks_file))
+        record("store-warm", seconds, peak, rss, num_plays, "plays")
+
+    if "frequency" in stages:
+        store = history.HistoryStore.load(tracks_file)
+        year = datetime.datetime(2017, 1, 1, tzinfo=datetime.timezone.utc)
+        next_year = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+        _, seconds, peak, rss = measure(lambda: [store.album_counts(year, next_year) for _ in range(100)])
+        record("frequency", seconds, peak, rss, 100, "queries")
+
+    brackets = image.get_brackets(freq)
+    files = [f"{aid}.png" for aid in freq]
+    posters, sizes = image.group_posters(files, freq, brackets)
+    width, height = canvas_for(sum(size * size * num for size, num in sizes))
+
+    settings, seconds, peak, rss = measure(lambda: compute_settings(len(files), width, height, sizes))
+    if "settings" in stages:
+        record("settings", seconds, peak, rss, 1, "layouts")
+
+    if "allocate" not in stages and "render" not in stages:
+        return results
+
+    # Seeded before each pass so both make the same placement
+    placement, seconds, peak, rss = measure(lambda: image.do_allocation(settings, posters),
+                                            lambda: random.seed(seed))
+    if "allocate" in stages:
+        record("allocate", seconds, peak, rss, num_albums, "albums")
+
+    if "render" in stages:
+        artwork_dir = os.path.join(work_dir, "artwork")
+        make_artwork(artwork_dir, freq.keys(), seed=seed)
+        poster_image = image.PosterImage(width, height, int(settings.right_margin_px / 2),
+                                         int(settings.bottom_margin_px / 2))
+        _, seconds, peak, rss = measure(lambda: image.render_serial(placement, settings, artwork_dir, poster_image))
+        record("render", seconds, peak, rss, len(placement.placements), "albums")
+
+    return results
+
+
+# Prints stages that got slower than the baseline by more than threshold, returns how many did
+def compare(results, baseline, threshold=0.1):
+    base_seconds = {(r["stage"], r["albums"]): r["seconds"] for r in baseline["results"]}
+    regressions = 0
+    for r in results:
+        key = (r["stage"], r["albums"])
+        if key not in base_seconds or base_seconds[key] == 0:
+            continue
+
+        change = r["seconds"] / base_seconds[key] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{r['stage']:>10} {r['albums']:>7} albums  {base_seconds[key]:8.3f}s -> {r['seconds']:8.3f}s "
+              f"({100 * change:+.1f}%){flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark poster generation on synthetic data")
+    parser.add_argument("--albums", type=int, nargs="+", default=[500, 2000, 5000])
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    results = []
+    for num_albums in args.albums:
+        work_dir = tempfile.mkdtemp(prefix="poster-bench-")
+        try:
+            results.extend(bench_albums(num_albums, work_dir, args.stages, args.seed))
+        finally:
+            shutil.rmtree(work_dir)
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "created": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold) > 0:
+                exit(1)
+
+
+if __name__ == "__main__":
+    main()
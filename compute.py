@@ -1,5 +1,7 @@
 from typing import Tuple, List
+import json
 import math
+from instrument import stats, PROGRESS
 
 
 class Settings:
@@ -15,33 +17,59 @@ class Settings:
         self.bottom_margin_px = 0
 
 
+# Kept next to a saved placement, so it can later be updated or re-rendered on exactly the same grid
+def save_settings(settings: Settings, file: str):
+    with open(file, "w") as f:
+        json.dump(vars(settings), f)
+
+
+def load_settings(file: str) -> Settings:
+    settings = Settings(0, 0, 0, 0)
+    with open(file, "r") as f:
+        settings.__dict__.update(json.load(f))
+    return settings
+
+
 def num_can_fit(width, height, settings):
     settings.num_along = int(width / settings.dim)
     settings.num_down = int(height / settings.dim)
     return settings.num_down * settings.num_along
 
 
-def compute_settings(num_squares: int, width: int, height: int, sizes: List[Tuple[int, int]]):
-    # Recompute num_squares according to their size
-    N_posters = num_squares
-    new_num_sq = 0
+def num_cells(sizes: List[Tuple[int, int]]):
+    # Grid cells needed for (size, count) pairs, a size n square takes n * n cells
+    cells = 0
     for size, num in sizes:
-        new_num_sq += (size * size) * num
+        cells += (size * size) * num
+    return cells
 
-    assert (new_num_sq >= num_squares)
-    num_squares = new_num_sq
 
-    total = 1000000000
-    settings = Settings(0, 0, 1, 0)
+def best_dim(num_squares: int, width: int, height: int):
+    # Same dim the old search found by counting up from 1: the smallest dim >= 2 at which no more than
+    # num_squares fit, backed off by one unless exactly num_squares fit there.
+    # Squares that fit only go down as dim goes up, so binary search for it
+    def fit(dim):
+        return int(width / dim) * int(height / dim)
 
-    while total > num_squares:
-        settings.dim += 1
-        total = num_can_fit(width, height, settings)
+    lo = 2
+    hi = max(2, min(width, height) + 1)  # Nothing fits past the short side
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if fit(mid) <= num_squares:
+            hi = mid
+        else:
+            lo = mid + 1
 
-    if total < num_squares:
-        settings.dim -= 1
+    if fit(lo) < num_squares:
+        return lo - 1
+    return lo
 
-    assert (num_can_fit(width, height, settings) >= num_squares)
+
+# Works out the grid and margins without printing anything, returns None if the squares can't fit
+def solve_settings(num_squares: int, width: int, height: int) -> Settings:
+    settings = Settings(0, 0, best_dim(num_squares, width, height), 0)
+    if num_can_fit(width, height, settings) < num_squares:
+        return None
 
     # compute the excess number of squares
     settings.excess_squares = (settings.num_down * settings.num_along) - num_squares
@@ -80,7 +108,22 @@ def compute_settings(num_squares: int, width: int, height: int, sizes: List[Tupl
     settings.bottom_margin_px = math.ceil(
         settings.dim * (((height / settings.dim) - settings.num_down) + settings.excess_rows))
 
-    print_settings(settings, width, height, sizes, N_posters)
+    return settings
+
+
+def compute_settings(num_squares: int, width: int, height: int, sizes: List[Tuple[int, int]]):
+    # Recompute num_squares according to their size
+    N_posters = num_squares
+    new_num_sq = num_cells(sizes)
+
+    assert (new_num_sq >= num_squares)
+    num_squares = new_num_sq
+
+    settings = solve_settings(num_squares, width, height)
+    assert settings is not None
+
+    if stats.enabled(PROGRESS):
+        print_settings(settings, width, height, sizes, N_posters)
 
     # Some sanity checks
     assert (settings.right_margin_px >= 0)
@@ -88,8 +131,40 @@ def compute_settings(num_squares: int, width: int, height: int, sizes: List[Tupl
     return settings
 
 
+class LayoutPlan:
+    def __init__(self, width: int, height: int, sizes: List[Tuple[int, int]], settings: Settings):
+        self.width = width
+        self.height = height
+        self.sizes = sizes
+        self.settings = settings
+        # Fraction of the canvas not covered by artwork
+        self.waste = 1 - (num_cells(sizes) * settings.dim * settings.dim) / (width * height)
+
+
+def canvas_sizes(formats: List[Tuple[float, float]], dpis: List[int]) -> List[Tuple[int, int]]:
+    # Pixel canvases for print formats given in inches at each dpi
+    canvases = []
+    for width_in, height_in in formats:
+        for dpi in dpis:
+            canvases.append((int(width_in * dpi), int(height_in * dpi)))
+    return canvases
+
+
+# Solves every combination of canvas and size mix (e.g. from different bracket splits)
+# and returns the ones that fit, least wasted canvas first
+def plan_layouts(canvases: List[Tuple[int, int]], size_mixes: List[List[Tuple[int, int]]]) -> List[LayoutPlan]:
+    plans = []
+    for width, height in canvases:
+        for sizes in size_mixes:
+            settings = solve_settings(num_cells(sizes), width, height)
+            if settings is not None and settings.right_margin_px >= 0 and settings.bottom_margin_px >= 0:
+                plans.append(LayoutPlan(width, height, sizes, settings))
+
+    return sorted(plans, key=lambda plan: plan.waste)
+
+
 def print_settings(settings: Settings, canvas_width, canvas_height, counts, N_posters):
-    num_sq = counts[0][1] + 4 * counts[1][1] + 16 * counts[2][1]
+    num_sq = num_cells(counts)
     print("across x down: ", settings.num_along, settings.num_down)
     print("width x height: ", canvas_width, canvas_height)
     print("N posters: ", N_posters)
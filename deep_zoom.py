@@ -0,0 +1,114 @@
+from PIL import Image
+import math
+import multiprocessing
+import os
+
+TILE_SIZE = 256
+
+
+def encode_tile(job):
+    file, size, raw, format = job
+    Image.frombytes("RGB", size, raw).save(file, format=format)
+
+
+# Writes a Deep Zoom (DZI) tile pyramid a strip of rows at a time, fed the same way as StreamingPNGWriter.
+# The top level is the full image and each level below is half the one above, down to a single pixel.
+# A level is built by box downsampling each completed row of tiles of the level above, so the full image is
+# never needed and every level is finished in the one pass. Tiles are encoded on a pool of processes, or as
+# they are cut with processes=0
+class DeepZoomWriter:
+
+    def __init__(self, file: str, width: int, height: int, tile_size=TILE_SIZE, format="png", processes=None):
+        assert tile_size % 2 == 0
+        self.file = file  # e.g. out.dzi, with the tiles in out_files/<level>/<column>_<row>.png
+        self.tiles_dir = f"{os.path.splitext(file)[0]}_files"
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.format = format
+        self.rows_written = 0
+
+        self.max_level = math.ceil(math.log2(max(width, height)))
+        self.widths = [-(-width // 2 ** (self.max_level - level)) for level in range(self.max_level + 1)]
+        self.pending = [None] * (self.max_level + 1)  # Rows of each level not yet cut into tiles
+        self.tile_rows = [0] * (self.max_level + 1)
+        for level in range(self.max_level + 1):
+            os.makedirs(f"{self.tiles_dir}/{level}", exist_ok=True)
+
+        self.pool = None if processes == 0 else multiprocessing.Pool(processes)
+        # Tiles handed to the pool but not yet written, bounded so memory stays flat
+        self.in_flight = []
+        self.max_in_flight = 4 * (processes or os.cpu_count())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self.pool is not None:
+            self.pool.terminate()
+
+    def write_strip(self, strip: Image):
+        assert strip.mode == "RGB" and strip.width == self.width
+        assert self.rows_written + strip.height <= self.height
+
+        self._add_rows(self.max_level, strip)
+        self.rows_written += strip.height
+
+    def _add_rows(self, level, rows: Image):
+        pending = self.pending[level]
+        if pending is not None:
+            joined = Image.new("RGB", (rows.width, pending.height + rows.height))
+            joined.paste(pending, (0, 0))
+            joined.paste(rows, (0, pending.height))
+            rows = joined
+
+        while rows.height >= self.tile_size:
+            self._emit(level, rows.crop((0, 0, rows.width, self.tile_size)))
+            rows = rows.crop((0, self.tile_size, rows.width, rows.height))
+
+        self.pending[level] = rows if rows.height > 0 else None
+
+    # Writes one row of tiles of a level and passes it down, halved, to the level below
+    def _emit(self, level, rows: Image):
+        row = self.tile_rows[level]
+        for column, x in enumerate(range(0, rows.width, self.tile_size)):
+            tile = rows.crop((x, 0, min(x + self.tile_size, rows.width), rows.height))
+            file = f"{self.tiles_dir}/{level}/{column}_{row}.{self.format}"
+            self._submit((file, tile.size, tile.tobytes(), self.format))
+        self.tile_rows[level] += 1
+
+        if level > 0:
+            self._add_rows(level - 1, rows.resize((self.widths[level - 1], -(-rows.height // 2)), Image.BOX))
+
+    def _submit(self, job):
+        if self.pool is None:
+            encode_tile(job)
+            return
+
+        self.in_flight.append(self.pool.apply_async(encode_tile, (job,)))
+        if len(self.in_flight) > self.max_in_flight:
+            self.in_flight.pop(0).get()
+
+    def close(self):
+        assert self.rows_written == self.height
+        # Top down, so each partial row of tiles adds its last rows to the level below before that is flushed
+        for level in range(self.max_level, -1, -1):
+            if self.pending[level] is not None:
+                rows = self.pending[level]
+                self.pending[level] = None
+                self._emit(level, rows)
+
+        if self.pool is not None:
+            for result in self.in_flight:
+                result.get()
+            self.pool.close()
+            self.pool.join()
+
+        with open(self.file, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{self.format}" '
+                    f'Overlap="0" TileSize="{self.tile_size}">\n'
+                    f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                    '</Image>\n')
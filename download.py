@@ -1,30 +1,155 @@
 import requests
+import requests.adapters
+from PIL import Image
+import atlas
 import shutil
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def download_art(ext: str= ""):
-    art = open(f"Spotify-listening-data/art{ext}.csv").read().split("\n")
-    existing_files = os.listdir(f"artwork{ext}")
+MANIFEST_FILE = ".manifest"
 
-    N = len(art)
-    i = 0
-    for item in art:
-        i += 1
+
+def read_art_list(csv_file: str):
+    items = []
+    for item in open(csv_file).read().split("\n"):
         if len(item) == 0:
             continue
-        url = item.split(",")[1]
         id = item.split(",")[0]
+        url = item.split(",")[1]
+        items.append((id, url))
+
+    return items
+
+
+# Ids whose artwork finished downloading. Only ids in here are skipped on a rerun,
+# so files left half written by an interrupted run are fetched again
+class Manifest:
+
+    def __init__(self, out_dir: str):
+        self.file = os.path.join(out_dir, MANIFEST_FILE)
+        self.done = set()
+        self.lock = threading.Lock()
+        if os.path.exists(self.file):
+            for line in open(self.file).read().split("\n"):
+                if len(line) > 0:
+                    self.done.add(line.split(",")[0])
+        elif os.path.isdir(out_dir):
+            self.seed(out_dir)
+
+    # Artwork directories from before the manifest have none. Covers there that decode completely count as
+    # downloaded (with no url), so the first run doesn't fetch them all again
+    def seed(self, out_dir: str):
+        for name in sorted(os.listdir(out_dir)):
+            if not name.endswith(".png"):
+                continue
+            try:
+                with Image.open(os.path.join(out_dir, name)) as cover:
+                    cover.load()
+            except (OSError, SyntaxError):
+                continue
+            self.add(name[:-len(".png")], "")
+
+    def __contains__(self, id):
+        return id in self.done
+
+    def add(self, id: str, url: str):
+        with self.lock:
+            self.done.add(id)
+            with open(self.file, "a") as f:
+                f.write(f"{id},{url}\n")
+
+
+def make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Download to a temp file next to dest and rename, so dest only ever exists complete
+def fetch(session: requests.Session, url: str, dest: str, retries=3, backoff=0.5, timeout=30):
+    tmp = f"{dest}.part"
+    for attempt in range(retries + 1):
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                with open(tmp, "wb") as out_file:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        out_file.write(chunk)
+            os.replace(tmp, dest)
+            return True
+        except (requests.RequestException, OSError) as e:
+            print(f"Failed to download {url} (attempt {attempt + 1}): {e}")
+            if attempt < retries:
+                time.sleep(backoff * (2 ** attempt))
+
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    return False
+
+
+def copy_atomic(src: str, dest: str):
+    tmp = f"{dest}.part"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def download_all(items, out_dir: str, workers=16, retries=3, backoff=0.5):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = Manifest(out_dir)
+
+    # Albums sharing artwork only need it fetched once
+    ids_for_url = {}
+    for id, url in items:
+        if id not in manifest:
+            ids_for_url.setdefault(url, []).append(id)
+
+    print(f"{len(items) - sum(len(ids) for ids in ids_for_url.values())} already downloaded, "
+          f"{len(ids_for_url)} to fetch")
+
+    session = make_session(workers)
+    failed = []
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {}
+        for url, ids in ids_for_url.items():
+            future = pool.submit(fetch, session, url, f"{out_dir}/{ids[0]}.png", retries, backoff)
+            futures[future] = url
+
+        i = 0
+        for future in as_completed(futures):
+            i += 1
+            url = futures[future]
+            ids = ids_for_url[url]
+            if not future.result():
+                failed.extend(ids)
+                continue
+
+            for id in ids[1:]:
+                copy_atomic(f"{out_dir}/{ids[0]}.png", f"{out_dir}/{id}.png")
+
+            for id in ids:
+                manifest.add(id, url)
+
+            print(f"Downloading [{int(100 * (i / len(futures)))}%]  {ids[0]}")
+
+    if len(failed) > 0:
+        print(f"Failed to download {len(failed)} covers, rerun to retry them")
+
+    return failed
 
-        if f"{id}.png" in existing_files:
-            print("skipping existing file")
-            continue
 
-        print(f"Downloading [{int(100 * (i / N))}%]  {id}")
-        response = requests.get(url, stream=True)
-        with open(f"artwork{ext}/{id}.png", "wb") as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        del response
+# With pack_atlas the covers are also packed into artwork.atlas so rendering doesn't have to open every file.
+# Off by default as the atlas is several times the size of the covers, see atlas.py. Only new covers are packed.
+# Pass the poster's largest square px (dim * 4) as tile_px, or image.main packs every cover again at that size
+def download_art(ext: str = "", pack_atlas=False, tile_px=atlas.TILE_PX):
+    items = read_art_list(f"Spotify-listening-data/art{ext}.csv")
+    download_all(items, f"artwork{ext}")
+    if pack_atlas:
+        atlas.build_atlas(f"artwork{ext}", f"artwork{ext}.atlas", tile_px)
 
 
 if __name__ == '__main__':
-    download_art()
\ No newline at end of file
+    download_art()
@@ -0,0 +1,247 @@
+from array import array
+import bisect
+import datetime
+import json
+import os
+import pickle
+import sys
+import dateutil.parser
+from instrument import stats
+
+TRACKS_FILE = "Spotify-listening-data/tracks.json"
+CACHE_VERSION = 2  # Of both the play cache and the history store
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Play:
+    # Field positions in the play tuples returned by iter_plays and load_plays
+    TIME = 0  # Microseconds since the epoch, UTC
+    SONG_ID = 1
+    ARTIST_ID = 2
+    ALBUM_ID = 3
+    SONG = 4
+    ARTIST = 5
+    ALBUM = 6
+
+
+def parse_timestamp(text: str) -> datetime.datetime:
+    # Exports use ISO 8601 like 2019-01-12T10:20:30.123Z, which fromisoformat handles much faster than dateutil
+    try:
+        if text.endswith("Z"):
+            text = text[:-1] + "+00:00"
+        date = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        date = dateutil.parser.parse(text)
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
+def to_micros(date: datetime.datetime) -> int:
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_micros(micros: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+# Remember the json files are not really json, there is one object per line
+def iter_plays(file: str = TRACKS_FILE):
+    with open(file, "r") as f:
+        for line in f:
+            if len(line) <= 2:
+                continue
+
+            track_json = json.loads(line)
+            track = track_json["track"]
+            artist = track["artists"][0]
+            album = track["album"]
+            # Ids repeat across plays, interning shares one string per id (and keeps the cache small)
+            yield (to_micros(parse_timestamp(track_json["played_at"]["$date"])),
+                   sys.intern(track["id"]),
+                   sys.intern(artist["id"]),
+                   sys.intern(album["id"]),
+                   sys.intern(track["name"]),
+                   sys.intern(artist["name"]),
+                   sys.intern(album["name"]))
+
+
+def _source_stamp(file: str):
+    stat = os.stat(file)
+    return {"version": CACHE_VERSION, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _read_cache(cache_file: str, stamp):
+    if not os.path.exists(cache_file):
+        return None
+
+    with open(cache_file, "rb") as f:
+        # The stamp is pickled separately first, so a stale cache is detected without loading the plays
+        if pickle.load(f) != stamp:
+            return None
+        return pickle.load(f)
+
+
+# All plays sorted by time, from the cache next to the source file if it is still valid
+def load_plays(file: str = TRACKS_FILE, cache_file: str = None):
+    if cache_file is None:
+        cache_file = f"{file}.cache"
+
+    stamp = _source_stamp(file)
+    with stats.span("parse"):
+        plays = _read_cache(cache_file, stamp)
+        if plays is not None:
+            stats.count("history cache hits")
+            return plays
+
+        stats.count("history cache misses")
+        plays = sorted(iter_plays(file), key=lambda play: play[Play.TIME])
+
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(stamp, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(plays, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    return plays
+
+
+# Listening history as parallel arrays, one entry per play sorted by time.
+# Ids are stored as integer codes into per-kind tables so each distinct id is kept once.
+# load keeps the built store next to the source file: a pickled stamp and the id tables, then the raw bytes of
+# the arrays and the checkpoints, so a later run reads them straight back without parsing the history again.
+# It doesn't go through load_plays, whose cache of play tuples is only for process_tracks
+class HistoryStore:
+    # Plays between album count checkpoints
+    BLOCK = 4096
+
+    def __init__(self, plays):
+        self.album_ids = []
+        self.artist_ids = []
+        self.track_ids = []
+        self.album_names = {}  # Album id -> name
+
+        self.times = array("q")
+        self.albums = array("i")
+        self.artists = array("i")
+        self.tracks = array("i")
+
+        album_codes = {}
+        artist_codes = {}
+        track_codes = {}
+        for play in plays:
+            self.times.append(play[Play.TIME])
+            self.albums.append(self._code(album_codes, self.album_ids, play[Play.ALBUM_ID]))
+            self.artists.append(self._code(artist_codes, self.artist_ids, play[Play.ARTIST_ID]))
+            self.tracks.append(self._code(track_codes, self.track_ids, play[Play.SONG_ID]))
+            self.album_names[play[Play.ALBUM_ID]] = play[Play.ALBUM]
+
+        # checkpoints[b][code] is the number of plays of album code in the first b * BLOCK plays,
+        # so a time range is counted from two checkpoints plus at most two partial blocks
+        self.checkpoints = []
+        running = array("i", [0] * len(self.album_ids))
+        for i, code in enumerate(self.albums):
+            if i % self.BLOCK == 0:
+                self.checkpoints.append(array("i", running))
+            running[code] += 1
+
+    @staticmethod
+    def _code(codes, ids, id):
+        if id not in codes:
+            codes[id] = len(ids)
+            ids.append(id)
+        return codes[id]
+
+    @classmethod
+    def load(cls, file: str = TRACKS_FILE, store_file: str = None):
+        if store_file is None:
+            store_file = f"{file}.store"
+
+        stamp = dict(_source_stamp(file), kind="store")
+        with stats.span("history store"):
+            store = cls._read(store_file, stamp)
+            if store is not None:
+                stats.count("history store hits")
+                return store
+
+            stats.count("history store misses")
+            # Parsed straight into the arrays, the store is all that's kept so the play cache isn't written
+            store = cls(sorted(iter_plays(file), key=lambda play: play[Play.TIME]))
+            store._write(store_file, stamp)
+        return store
+
+    @classmethod
+    def _read(cls, store_file: str, stamp):
+        if not os.path.exists(store_file):
+            return None
+
+        with open(store_file, "rb") as f:
+            if pickle.load(f) != stamp:
+                return None
+
+            store = cls.__new__(cls)
+            store.album_ids, store.artist_ids, store.track_ids, store.album_names, length, num_checkpoints = \
+                pickle.load(f)
+            store.times = array("q")
+            store.albums = array("i")
+            store.artists = array("i")
+            store.tracks = array("i")
+            for column in (store.times, store.albums, store.artists, store.tracks):
+                column.fromfile(f, length)
+
+            checkpoints = array("i")
+            checkpoints.fromfile(f, num_checkpoints * len(store.album_ids))
+            num_albums = len(store.album_ids)
+            store.checkpoints = [checkpoints[b * num_albums:(b + 1) * num_albums] for b in range(num_checkpoints)]
+        return store
+
+    def _write(self, store_file: str, stamp):
+        tmp_file = f"{store_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(stamp, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((self.album_ids, self.artist_ids, self.track_ids, self.album_names, len(self.times),
+                         len(self.checkpoints)), f, pickle.HIGHEST_PROTOCOL)
+            for column in (self.times, self.albums, self.artists, self.tracks):
+                column.tofile(f)
+            for checkpoint in self.checkpoints:
+                checkpoint.tofile(f)
+        os.replace(tmp_file, store_file)
+
+    def __len__(self):
+        return len(self.times)
+
+    def index_at(self, date: datetime.datetime):
+        # Index of the first play at or after date
+        return bisect.bisect_left(self.times, to_micros(date))
+
+    def _counts_before(self, index):
+        block = index // self.BLOCK
+        if block >= len(self.checkpoints):
+            block = len(self.checkpoints) - 1
+
+        counts = array("i", self.checkpoints[block])
+        for code in self.albums[block * self.BLOCK:index]:
+            counts[code] += 1
+        return counts
+
+    # Album id -> number of plays in [start, end), the same shape album_frequency returns.
+    # start and end are timezone aware datetimes, None means unbounded
+    def album_counts(self, start: datetime.datetime = None, end: datetime.datetime = None):
+        if len(self.times) == 0:
+            return {}
+
+        lo = 0 if start is None else self.index_at(start)
+        hi = len(self.times) if end is None else self.index_at(end)
+        if hi <= lo:
+            return {}
+
+        before = self._counts_before(lo)
+        upto = self._counts_before(hi)
+        counts = {}
+        for code, album_id in enumerate(self.album_ids):
+            n = upto[code] - before[code]
+            if n > 0:
+                counts[album_id] = n
+
+        return counts
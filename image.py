@@ -1,11 +1,28 @@
 from PIL import Image
 import random
 import os
+import bisect
+import itertools
+import contextlib
+import hashlib
+from array import array
 from compute import *
-import json
-import dateutil.parser
 import datetime
+import multiprocessing
+import queue
+import threading
 import download
+import history
+from history import Play
+from stream_png import png_writer
+from deep_zoom import DeepZoomWriter, TILE_SIZE
+from tile_cache import TileCache
+from atlas import Atlas, build_atlas
+from array_canvas import ArrayCanvas
+from pipeline import Pipeline
+import placement_file
+from placement_file import PlacementJournal
+from instrument import stats, PROGRESS, DEBUG
 
 ALBUMS_TO_IGNORE = [
     "3UVJu0QdTJBfGJBl1AMWEM"  # Remaster version of Either/Or - just use original instead
@@ -42,11 +59,45 @@ class PosterImage:
         self.top_margin = top_margin
         self.base = Image.new("RGB", (width, height), "white")
 
+    @classmethod
+    def from_file(cls, file: str, left_margin, top_margin):
+        # Continue from a previously saved render, e.g. to patch it after an incremental update
+        image = Image.open(file).convert("RGB")
+        poster_image = cls(0, 0, left_margin, top_margin)
+        poster_image.width, poster_image.height = image.size
+        poster_image.base = image
+        return poster_image
+
     def add_image(self, image: Image, x_pos: float, y_pos: float):
-        self.base.paste(image, (x_pos + self.left_margin, y_pos + self.top_margin))
+        with stats.span("paste"):
+            self.base.paste(image, (x_pos + self.left_margin, y_pos + self.top_margin))
+
+    def paste(self, image: Image, x, y):
+        # Position on the canvas, ignoring the margins
+        with stats.span("paste"):
+            self.base.paste(image, (x, y))
+
+    # With processes other than 1 the PNG is compressed a strip at a time on that many processes (None for all
+    # cores) rather than by PIL on one. compress_level is zlib's, 1 is fastest and 9 smallest
+    def save(self, file="out.png", safety_px=0, compress_level=6, processes=1):
+        with stats.span("save"):
+            image = self.base
+            if safety_px > 0:
+                image = add_safety_margin(self.base, self.width, self.height, safety_px)
+
+            if processes == 1:
+                image.save(file, compress_level=compress_level)
+                return
 
-    def save(self):
-        self.base.save("out.png")
+            with png_writer(file, image.width, image.height, compress_level, processes) as writer:
+                for y in range(0, image.height, TILE_SIZE):
+                    writer.write_strip(image.crop((0, y, image.width, min(y + TILE_SIZE, image.height))))
+
+    def save_deep_zoom(self, file="out.dzi", processes=None):
+        # Tile pyramid for zooming around the poster in a browser
+        with stats.span("deep zoom"), DeepZoomWriter(file, self.width, self.height, processes=processes) as writer:
+            for y in range(0, self.height, TILE_SIZE):
+                writer.write_strip(self.base.crop((0, y, self.width, min(y + TILE_SIZE, self.height))))
 
 
 class PosterFitter:
@@ -60,41 +111,95 @@ class PosterFitter:
         self.height = 0
 
 
+def adjacency_reach(size):
+    # How far (in cells, along each axis) two squares of this size must be apart to not count as adjacent
+    if size > 2:
+        return size + 2
+    return size
+
+
+class SquareIndex:
+    # Placed squares of one size plus the set of origins that would be adjacent to any of them,
+    # marked when each square is added so adjacency checks are a single lookup
+
+    def __init__(self, reach):
+        self.reach = reach
+        self.squares = []
+        self.near = set()
+
+    def add(self, x, y):
+        self.squares.append((x, y))
+        for nx in range(x - self.reach, x + self.reach + 1):
+            for ny in range(y - self.reach, y + self.reach + 1):
+                self.near.add((nx, ny))
+
+    def has_within(self, x, y):
+        return (x, y) in self.near
+
+
+# Owner code of cells that are taken but not by any album, e.g. ones outside what a region may use
+BLOCKED = 0xFFFFFFFF
+
+
 class Placement:
 
     def __init__(self, n_x, n_y):
         self.n_x = n_x
         self.n_y = n_y
-        self.places = [0] * self.n_x * self.n_y
+        self.places = self._new_grid()
         self.placements = {}  # Map from album id to coordinates
         self.placement_size = {}
+        self.album_ids = []  # Album ids by owner code - 1, codes are never reused
+        self.album_codes = {}  # Map from album id to its owner code
+        self.origins = {}  # Map from size to (x, y) origins where a square of that size fits, in grid scan order
+        self.square_index = {}  # Map from size to SquareIndex of placed squares of that size
+        self.distance_sums = {}  # Map from size to {origin: sum of distances to squares of that size}
+        self.journal = None  # PlacementJournal every placed square is appended to, if any
 
     def print_placement(self):
+        if not stats.enabled(DEBUG):
+            return
+
         for y in range(self.n_y):
             # print("{}| ".format(y), end="")
 
             for x in range(self.n_x):
                 idx = self._xy_to_index(x, y)
-                print(self.places[idx], end=" ")
+                print(1 if self.places[idx] else 0, end=" ")
 
             print()
 
+    def _new_grid(self):
+        # Ownership grid, each cell holds the owner code of the album covering it, 0 if free or BLOCKED
+        return array("I", bytes(4 * self.n_x * self.n_y))
+
     def _xy_to_index(self, x, y):
         return y * self.n_x + x
 
-    def alloc(self, x, y):
+    def _owner_code(self, aid: str):
+        if aid not in self.album_codes:
+            self.album_ids.append(aid)
+            self.album_codes[aid] = len(self.album_ids)
+        return self.album_codes[aid]
+
+    def alloc(self, x, y, code):
         pos = self._xy_to_index(x, y)
         assert (self.places[pos] == 0)
-        self.places[pos] = 1
+        self.places[pos] = code
 
-    def alloc_square(self, x, y, size):
+    def alloc_square(self, x, y, size, code):
         if size == 1:
-            self.alloc(x, y)
-            return
+            self.alloc(x, y, code)
+        else:
+            for x_add in range(size):
+                for y_add in range(size):
+                    self.alloc(x + x_add, y + y_add, code)
 
-        for x_add in range(size):
-            for y_add in range(size):
-                self.alloc(x + x_add, y + y_add)
+        # Any origin whose square overlaps the one just allocated is no longer free
+        for origin_size, origins in self.origins.items():
+            for ox in range(max(0, x - origin_size + 1), x + size):
+                for oy in range(max(0, y - origin_size + 1), y + size):
+                    origins.pop((ox, oy), None)
 
     def is_free(self, x, y):
         return self.places[self._xy_to_index(x, y)] == 0
@@ -113,57 +218,152 @@ class Placement:
 
         return True
 
+    def _build_origins(self, size):
+        # Summed-area table of the occupancy grid so each size x size block is checked in O(1)
+        w = self.n_x + 1
+        table = [0] * (w * (self.n_y + 1))
+        for y in range(self.n_y):
+            row_sum = 0
+            for x in range(self.n_x):
+                row_sum += 1 if self.places[self._xy_to_index(x, y)] else 0
+                table[(y + 1) * w + x + 1] = table[y * w + x + 1] + row_sum
+
+        # A dict rather than a set: removals keep the x-then-y scan order, so seeded runs stay reproducible
+        origins = {}
+        for x in range(self.n_x - size + 1):
+            for y in range(self.n_y - size + 1):
+                used = table[(y + size) * w + x + size] - table[y * w + x + size] \
+                       - table[(y + size) * w + x] + table[y * w + x]
+                if used == 0:
+                    origins[(x, y)] = None
+
+        return origins
+
+    def free_origins(self, size):
+        # Built once per size with a full scan, then kept up to date by alloc_square
+        if size not in self.origins:
+            self.origins[size] = self._build_origins(size)
+        return self.origins[size]
+
+    def candidate_spaces(self, size, border_basic=0, border_bottom_x=0, border_bottom_y=0):
+        max_x = self.n_x - border_bottom_x - size
+        max_y = self.n_y - border_bottom_y - size
+        return [(x, y) for x, y in self.free_origins(size)
+                if border_basic <= x <= max_x and border_basic <= y <= max_y]
+
+    def place_square(self, aid: str, x, y, size):
+        self.placements[aid] = (x, y)
+        self.placement_size[aid] = size
+        self.alloc_square(x, y, size, self._owner_code(aid))
+
+        if self.journal is not None:
+            self.journal.write(aid, x, y, size)
+
+        if size in self.square_index:
+            self.square_index[size].add(x, y)
+
+        if size in self.distance_sums:
+            sums = self.distance_sums[size]
+            for ox, oy in self.free_origins(size):
+                sums[(ox, oy)] += math.sqrt((ox - x) * (ox - x) + (oy - y) * (oy - y))
+
+    def squares_of_size(self, size) -> SquareIndex:
+        if size not in self.square_index:
+            index = SquareIndex(adjacency_reach(size))
+            for album_id in self.placement_size:
+                if self.placement_size[album_id] == size:
+                    index.add(*self.placements[album_id])
+            self.square_index[size] = index
+
+        return self.square_index[size]
+
+    def distances_to_size(self, size):
+        # Sum of distances from each free origin to every placed square of this size.
+        # Built once, then place_square adds the distance to each new square, so weighting is O(candidates).
+        # That update still visits every free origin, so placing a whole grid stays quadratic in its cells
+        # (about 2 s for 7k cells, 50 s for 29k). For big grids use the lattice engine or do_allocation_regions
+        if size not in self.distance_sums:
+            squares = self.squares_of_size(size).squares
+            sums = {}
+            for ox, oy in self.free_origins(size):
+                total = 0
+                for sx, sy in squares:
+                    total += math.sqrt((ox - sx) * (ox - sx) + (oy - sy) * (oy - sy))
+                sums[(ox, oy)] = total
+            self.distance_sums[size] = sums
+
+        return self.distance_sums[size]
+
     def random_coord(self) -> Tuple[int, int]:
         return random.randint(0, self.n_x - 1), random.randint(0, self.n_y - 1)
 
     def random_place(self, aid: str, size: int, border_basic=0, border_bottom_x=0, border_bottom_y=0):
         # First get list of coords with unallocated space
-        spaces = []
-        for x in range(self.n_x):
-            for y in range(self.n_y):
-                can_place = self.can_place_at(x, y, size)
-                in_border = (
-                                    x + border_bottom_x + size - 1 < self.n_x and y + border_bottom_y + size - 1 < self.n_y) and (
-                                    x >= border_basic and y >= border_basic)
-                if can_place and in_border:
-                    spaces.append((x, y))
+        spaces = self.candidate_spaces(size, border_basic, border_bottom_x, border_bottom_y)
 
         if len(spaces) == 0:
             # Failed to find place
             print("ERROR: FAILED TO FIND ALLOCATION FOR SIZE = {} ".format(size))
+            stats.count("failed placements")
             self.print_placement()
             return False
 
         x, y = random.choice(spaces)
-        self.placements[aid] = (x, y)
-        self.placement_size[aid] = size
-        self.alloc_square(x, y, size)
+        self.place_square(aid, x, y, size)
         return True
 
     # As placement allocation is getting slow, save so we can reload and then just regen image
     def save(self, file: str):
-        out = f"{self.n_x},{self.n_y}\n"
+        lines = [f"{self.n_x},{self.n_y}\n"]
         for aid in self.placements:
             size = self.placement_size[aid]
             x, y = self.placements[aid]
-            out += f"{x}, {y}, {size}, {aid}\n"
+            lines.append(f"{x}, {y}, {size}, {aid}\n")
+
+        open(file, "w+").write("".join(lines))
 
-        open(file, "w+").write(out)
+    def save_binary(self, file: str):
+        placement_file.write_placement(file, self.n_x, self.n_y, self.placements, self.placement_size)
 
-    def save_with_datetime(self, prefix):
+    def save_with_datetime(self, prefix, binary=True):
         now = datetime.datetime.now()
         file_name = f"{prefix}{now.year}-{now.month}-{now.day} {now.hour}:{now.minute}:{now.second}"
-        self.save(file_name)
+        if binary:
+            file_name = f"{file_name}.bin"
+            self.save_binary(file_name)
+        else:
+            self.save(file_name)
+        return file_name
+
+    def cells(self, aid: str):
+        x, y, size = self.extent(aid)
+        return [(x + x_add, y + y_add) for x_add in range(size) for y_add in range(size)]
 
+    def _reset(self, n_x, n_y):
+        self.n_x = n_x
+        self.n_y = n_y
+        self.places = self._new_grid()
+        self.placements = {}
+        self.placement_size = {}
+        self.album_ids = []
+        self.album_codes = {}
+        self.origins = {}
+        self.square_index = {}
+        self.distance_sums = {}
+
+    # Loads either the text format from save or the binary one from save_binary
     def load(self, file: str):
+        if placement_file.is_placement_file(file):
+            n_x, n_y, records = placement_file.read_placement(file)
+            self._reset(n_x, n_y)
+            for aid, x, y, size in records:
+                self.place_square(aid, x, y, size)
+            return
+
         with open(file, "r") as f:
             lines = f.read().split("\n")
             xy_parts = lines[0].split(",")
-            self.n_x = int(xy_parts[0])
-            self.n_y = int(xy_parts[1])
-            self.places = [0] * self.n_x * self.n_y
-            self.placements = {}
-            self.placement_size = {}
+            self._reset(int(xy_parts[0]), int(xy_parts[1]))
 
             for line in lines[1:]:
                 if len(line) == 0:
@@ -174,74 +374,72 @@ class Placement:
                 y = int(parts[1])
                 size = int(parts[2])
                 aid = parts[3].replace(" ", "")
-                self.alloc_square(x, y, size)
-                self.placements[aid] = (x, y)
-                self.placement_size[aid] = size
+                self.place_square(aid, x, y, size)
+
+    # Replays any placements already in the journal file, then journals every new placement to it. key identifies
+    # what is being allocated, a journal left by an allocation of anything else is discarded rather than replayed
+    def resume_journal(self, file: str, key: bytes):
+        if os.path.exists(file):
+            try:
+                n_x, n_y, journal_key, records = placement_file.read_journal(file)
+            except ValueError:
+                n_x, n_y, journal_key, records = None, None, None, []
+
+            if (n_x, n_y, journal_key) == (self.n_x, self.n_y, key):
+                for aid, x, y, size in records:
+                    self.place_square(aid, x, y, size)
+                stats.log(PROGRESS, f"Resumed {len(records)} placements from {file}")
+            else:
+                stats.log(PROGRESS, f"Discarding {file}, it is from a different allocation")
+                os.remove(file)
+
+        self.journal = PlacementJournal(file, self.n_x, self.n_y, key)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
 
     # Weigh by distance to other squares
-    # This function is full of very ineffcient algorithms
     def random_place_weighed(self, aid: str, size: int, border_basic=0, border_bottom_x=0, border_bottom_y=0):
         # First get list of coords with unallocated space
-        spaces = []
-        for x in range(self.n_x):
-            for y in range(self.n_y):
-                can_place = self.can_place_at(x, y, size)
-                in_border = (
-                                    x + border_bottom_x + size - 1 < self.n_x and y + border_bottom_y + size - 1 < self.n_y) and (
-                                    x >= border_basic and y >= border_basic)
-                if can_place and in_border:
-                    spaces.append((x, y))
+        spaces = self.candidate_spaces(size, border_basic, border_bottom_x, border_bottom_y)
+        stats.count("candidates scanned", len(spaces))
 
         if len(spaces) == 0:
             # Failed to find place
             print("ERROR: FAILED TO FIND ALLOCATION FOR SIZE = {} ".format(size))
+            stats.count("failed placements")
             self.print_placement()
             return False
 
         # Now determine weights for each space
         # Find all other squares of this size
-        squares_of_size = []
-        for album_id in self.placement_size:
-            if self.placement_size[album_id] == size:
-                squares_of_size.append(self.placements[album_id])
+        squares_of_size = self.squares_of_size(size)
 
         # Remove spaces that are close to other sizes
-        new_spaces = []
-        for space in spaces:
-            ok = True
-            for sq_of_size in squares_of_size:
-                if self.are_adjacent(space, sq_of_size, size):
-                    ok = False
-                    break
+        new_spaces = [space for space in spaces if not squares_of_size.has_within(*space)]
 
-            if ok:
-                new_spaces.append(space)
+        stats.count("adjacency rejections", len(spaces) - len(new_spaces))
 
         if len(new_spaces) == 0:
-            print("No spaces found, forgotting about adjacency")
+            stats.log(DEBUG, "No spaces found, forgotting about adjacency")
+            stats.count("adjacency fallbacks")
         else:
             spaces = new_spaces
-        distances = [0] * len(spaces)  # Sum of distances to each square
 
-        if len(squares_of_size) == 0:
+        if len(squares_of_size.squares) == 0:
             # No distances to consider, just to random choice
             x, y = random.choice(spaces)
         else:
-            # For each possible square, consider total distance
-            for i, candidate_pos in enumerate(spaces):
-                distances[i] = 0
-                for square_with_size in squares_of_size:
-                    distances[i] += self.dist(square_with_size[0], square_with_size[1], candidate_pos[0],
-                                              candidate_pos[1])
-
-            weights = [i / sum(distances) for i in distances]
-            print(weights, spaces)
-            x, y = random.choices(population=spaces, weights=weights, k=1)[0]
-
-        print(x, y, aid)
-        self.placements[aid] = (x, y)
-        self.placement_size[aid] = size
-        self.alloc_square(x, y, size)
+            # Weight each possible square by its total distance, sampled the same way as random.choices
+            distances = self.distances_to_size(size)
+            cum_weights = list(itertools.accumulate(distances[space] for space in spaces))
+            chosen = bisect.bisect(cum_weights, random.random() * cum_weights[-1], 0, len(spaces) - 1)
+            x, y = spaces[chosen]
+
+        stats.log(DEBUG, x, y, aid)
+        self.place_square(aid, x, y, size)
         return True
 
     def are_adjacent(self, c1, c2, size):
@@ -250,21 +448,17 @@ class Placement:
 
         dx = abs(x1 - x2)
         dy = abs(y1 - y2)
-        additional = 0
-        if size > 2:
-            additional = 2
-        return dx <= size + additional and dy <= size + additional
+        reach = adjacency_reach(size)
+        return dx <= reach and dy <= reach
 
     def place_first_fit(self, aid: str, size: int):
-        for y in range(self.n_y):
-            for x in range(self.n_x):
-                if self.can_place_at(x, y, size):
-                    self.placements[aid] = (x, y)
-                    self.alloc_square(x, y, size)
-                    self.placement_size[aid] = size
-                    return True
+        origins = self.free_origins(size)
+        if len(origins) == 0:
+            return False
 
-        return False
+        x, y = min(origins, key=lambda c: (c[1], c[0]))
+        self.place_square(aid, x, y, size)
+        return True
 
     def idx_to_coords(self, idx):
         x_pos = idx % self.n_x
@@ -274,19 +468,58 @@ class Placement:
     def alloc_all_size_ones(self, album_ids):
         idx = 0
         for aid in album_ids:
-            while self.places[idx] == 1:
+            while self.places[idx] != 0:
                 idx += 1
 
             x, y = self.idx_to_coords(idx)
-            self.placements[aid] = (x, y)
-            self.alloc_square(x, y, 1)
-            self.placement_size[aid] = 1
+            self.place_square(aid, x, y, 1)
+
+    def owner(self, x, y):
+        # Album id covering the cell, or None if it is free or blocked
+        code = self.places[self._xy_to_index(x, y)]
+        if code == 0 or code == BLOCKED:
+            return None
+        return self.album_ids[code - 1]
+
+    def extent(self, aid: str):
+        x, y = self.placements[aid]
+        return x, y, self.placement_size[aid]
 
     def find_aid_for_index(self, idx):
         x, y = self.idx_to_coords(idx)
-        for aid in self.placements:
-            if self.placements[aid] == (x, y):
-                return aid
+        return self.owner(x, y)
+
+    def region_owners(self, x_start, y_start, x_end, y_end):
+        # Distinct album ids covering any cell in [x_start, x_end) x [y_start, y_end), in scan order
+        codes = {}
+        for y in range(y_start, y_end):
+            row_start = self._xy_to_index(0, y)
+            for code in self.places[row_start + x_start:row_start + x_end]:
+                if code != 0 and code != BLOCKED:
+                    codes[code] = None
+
+        return [self.album_ids[code - 1] for code in codes]
+
+    def row_owners(self, y):
+        return self.region_owners(0, y, self.n_x, y + 1)
+
+    def free_square(self, aid: str):
+        x, y, size = self.extent(aid)
+        for y_add in range(size):
+            start = self._xy_to_index(x, y + y_add)
+            self.places[start:start + size] = array("I", bytes(4 * size))
+
+        del self.placements[aid]
+        del self.placement_size[aid]
+
+        # Freed cells can open up new origins, so rebuild lazily on next query
+        self.drop_indexes()
+
+    def drop_indexes(self):
+        # The free origin, square and distance indexes are all rebuilt on demand
+        self.origins = {}
+        self.square_index = {}
+        self.distance_sums = {}
 
     def remove_final_ones(self):
         row = self.n_y - 1
@@ -295,23 +528,80 @@ class Placement:
                 row -= 1
                 continue
 
+            # Everything from the start of the last row up to its first free cell
+            to_remove = []
             for col in range(self.n_x):
-                idx = self._xy_to_index(col, row)
-                if self.places[idx] == 0:
+                aid = self.owner(col, row)
+                if aid is None:
                     break
+                if aid not in to_remove:
+                    to_remove.append(aid)
 
-                aid = self.find_aid_for_index(idx)
-                self.places[idx] = 0
-                self.placement_size[aid] = 0
-                del self.placements[aid]
+            for aid in to_remove:
+                self.free_square(aid)
             break
 
     def dist(self, x1, y1, x2, y2):
         return math.sqrt(math.pow((x2 - x1), 2) + math.pow((y2 - y1), 2))
 
 
-def resize_for_size(image: Image, size: int, settings: Settings) -> Image:
-    return image.resize((settings.dim * size, settings.dim * size), Image.ANTIALIAS)
+RESIZE_FILTER = Image.LANCZOS  # What Image.ANTIALIAS was an alias of
+
+
+# With reduced, covers much bigger than the tile are first shrunk by a whole factor (JPEG decoders do this while
+# decoding, otherwise Image.reduce) and only the last step is resampled. Much faster for large covers, but the
+# pixels differ slightly from a full resample so it is kept off by default
+REDUCING_GAP = 3.0
+
+
+def resize_for_size(image: Image, size: int, settings: Settings, reduced=False) -> Image:
+    with stats.span("resize"):
+        return image.resize((settings.dim * size, settings.dim * size), RESIZE_FILTER,
+                            reducing_gap=REDUCING_GAP if reduced else None)
+
+
+# Artwork for aid resized to fill a square of the given size, going through the tile cache if there is one.
+# Cached tiles are stored as RGB, which is what pasting onto the RGB poster converts them to anyway.
+# base_dir is the artwork directory or an Atlas built from it
+def load_artwork(base_dir: str, aid: str, size: int, settings: Settings, tile_cache: TileCache = None,
+                 reduced=False) -> Image:
+    if tile_cache is None:
+        return read_artwork(base_dir, aid, size, settings, reduced)
+
+    source = base_dir.file if isinstance(base_dir, Atlas) else f"{base_dir}/{aid}.png"
+    px = settings.dim * size
+    key = tile_cache.key(aid, source, px, f"{RESIZE_FILTER}-reduced" if reduced else RESIZE_FILTER)
+    image = tile_cache.get(key, px)
+    if image is None:
+        stats.count("tile cache misses")
+        image = read_artwork(base_dir, aid, size, settings, reduced).convert("RGB")
+        tile_cache.put(key, image)
+    else:
+        stats.count("tile cache hits")
+
+    return image
+
+
+def read_artwork(base_dir: str, aid: str, size: int, settings: Settings, reduced=False) -> Image:
+    px = settings.dim * size
+    if isinstance(base_dir, Atlas):
+        # Already decoded and shrunk to a mip level, reduced makes no difference
+        with stats.span("atlas"):
+            return base_dir.artwork(aid, px, RESIZE_FILTER)
+
+    draft_px = int(px * REDUCING_GAP) if reduced else None
+    return resize_for_size(decode_artwork(f"{base_dir}/{aid}.png", draft_px), size, settings, reduced)
+
+
+def decode_artwork(file: str, draft_px: int = None) -> Image:
+    # draft_px lets JPEG covers (Spotify's are JPEG whatever the extension) decode at a reduced scale
+    # no smaller than that. Other formats ignore it
+    with stats.span("decode"):
+        image = Image.open(file)
+        if draft_px is not None:
+            image.draft("RGB", (draft_px, draft_px))
+        image.load()
+    return image
 
 
 def poster_id(file: str):
@@ -319,41 +609,22 @@ def poster_id(file: str):
 
 
 def process_tracks() -> List[Track]:
+    # Plays come back sorted by date
     tracks = []
+    for play in history.load_plays():
+        tracks.append(Track(history.from_micros(play[Play.TIME]), *play[Play.SONG_ID:]))
 
-    # Remember the json files are not really json
-    with open("Spotify-listening-data/tracks.json", "r") as f:
-        for track_str in f.read().split("\n"):
-            if len(track_str) > 1:
-                track_json = json.loads(track_str)
-                dt = dateutil.parser.parse(track_json["played_at"]["$date"])
-                track = Track(dt, track_json["track"]["id"],
-                              track_json["track"]["artists"][0]["id"],
-                              track_json["track"]["album"]["id"],
-                              track_json["track"]["name"],
-                              track_json["track"]["artists"][0]["name"],
-                              track_json["track"]["album"]["name"])
-                tracks.append(track)
-
-    # Now sort by date
-    return sorted(tracks, key=lambda x: x.date)
-
-
-def album_frequency():
-    albums = {}
-    for track in process_tracks():
-        if track.album_id in albums:
-            albums[track.album_id] += 1
-        else:
-            albums[track.album_id] = 1
+    return tracks
 
-    return albums
 
+# Plays per album, optionally only those in [start, end) for per-year or per-month posters
+def album_frequency(start: datetime.datetime = None, end: datetime.datetime = None):
+    return history.HistoryStore.load().album_counts(start, end)
 
-def get_brackets(a_freq):
+
+# Pass other proportions to try different splits with plan_layouts
+def get_brackets(a_freq, top_prop=0.01, middle_prop=0.1):
     freqs = sorted(a_freq.values())
-    top_prop = 0.01
-    middle_prop = 0.1
     bottom_prop = 1 - (top_prop + middle_prop)
 
     bottom_end = int(bottom_prop * len(freqs))
@@ -369,7 +640,8 @@ def get_brackets(a_freq):
 def get_size(freq, brackets, aid: str):
     if aid not in freq:
         # Not PC!
-        print(f"aid {aid} not in freqs!")
+        stats.log(DEBUG, f"aid {aid} not in freqs!")
+        stats.count("albums without plays")
         return 1
 
     top, middle, bottom = brackets
@@ -385,48 +657,727 @@ def get_size(freq, brackets, aid: str):
 
 
 def get_files(base_dir: str):
-    files = os.listdir(base_dir)
-    if ".DS_Store" in files:
-        files.remove(".DS_Store")
+    # Skips .DS_Store and the downloader's manifest and partial files
+    if isinstance(base_dir, Atlas):
+        files = base_dir.files()
+    else:
+        files = [file for file in os.listdir(base_dir) if file.endswith(".png")]
 
     for aid in ALBUMS_TO_IGNORE:
         if f"{aid}.png" in files:
             files.remove(f"{aid}.png")
-            print(f"Removed {aid}")
+            stats.log(PROGRESS, f"Removed {aid}")
 
     return files
 
 
-def do_allocation(settings: Settings, posters):
-    placement = Placement(settings.num_along - settings.excess_cols, settings.num_down)
+def played_files(files, freq):
+    # Only albums played in freq's date range, so e.g. a poster of one year isn't padded out with size 1
+    # covers of albums from other years
+    return [file for file in files if poster_id(file) in freq]
 
-    i = 0
-    for size, posters_for_size in enumerate(reversed(posters)):
-        size = len(posters) - size
-        placement.print_placement()
-        print()
 
-        if size == 1:
-            placement.alloc_all_size_ones(map(lambda p: poster_id(p), posters_for_size))
-            break
+# Splits artwork files into the lists do_allocation takes, indexed by square size - 1,
+# and the (size, count) pairs compute_settings takes
+def group_posters(files, freq, brackets):
+    posters = [[], [], []]
+    counts = [0, 0, 0]
+
+    for file in files:
+        aid = poster_id(file)
+        size = get_size(freq, brackets, aid)
+        posters[size - 1].append(file)
+        counts[size - 1] += 1
+
+    # The top bracket are drawn as size 4 squares
+    posters = [posters[0], posters[1], [], posters[2]]
+    return posters, [(1, counts[0]), (2, counts[1]), (4, counts[2])]
+
+
+# Raised when the squares don't fit on the grid, so callers can tell a dead end from a bug
+class AllocationFailed(Exception):
+    pass
 
-        for poster in posters_for_size:
-            i += 1
 
-            border = 1 + settings.excess_rows
-            if not placement.random_place_weighed(poster_id(poster), size, 1, border, border):
-                assert False
+# Placement engines decide where the squares of each size above 1 go. place_size places every album in aids
+# as a size x size square inside the border and returns False if it could not fit one of them
 
-            if i % 100 == 0:
-                print(f"Progress: {i}")
+class RandomEngine:
+    # Samples each square's position at random, weighted towards being far from the others of its size
+
+    def place_size(self, placement: Placement, aids, size, border_basic, border_bottom_x, border_bottom_y):
+        for i, aid in enumerate(aids):
+            if not placement.random_place_weighed(aid, size, border_basic, border_bottom_x, border_bottom_y):
+                return False
+
+            if (i + 1) % 100 == 0:
+                stats.log(PROGRESS, f"Progress: {i + 1} of size {size}")
+
+        return True
+
+
+class LatticeEngine:
+    # Splits the area squares of a size can go in into one cell per square, in a grid matching its aspect,
+    # and puts each square at the free origin nearest the centre of its cell (moved by up to jitter of a cell,
+    # from a seeded generator, so jitter=0 is fully deterministic). Each square only searches around its cell,
+    # so placing all of them is close to linear. Origins adjacent to a square of the same size are avoided
+    # unless none are free nearby, as random_place_weighed does
+
+    def __init__(self, jitter=0.0, seed=0):
+        self.jitter = jitter
+        self.seed = seed
+
+    def place_size(self, placement: Placement, aids, size, border_basic, border_bottom_x, border_bottom_y):
+        if len(aids) == 0:
+            return True
+
+        rng = random.Random(self.seed)
+        x_min = border_basic
+        y_min = border_basic
+        x_max = placement.n_x - border_bottom_x - size
+        y_max = placement.n_y - border_bottom_y - size
+        if x_max < x_min or y_max < y_min:
+            print("ERROR: FAILED TO FIND ALLOCATION FOR SIZE = {} ".format(size))
+            return False
+
+        width = x_max - x_min + 1
+        height = y_max - y_min + 1
+        cols = max(1, min(width, round(math.sqrt(len(aids) * width / height))))
+        rows = math.ceil(len(aids) / cols)
+        cell_w = width / cols
+        cell_h = height / rows
+
+        # Use cells spread evenly through the grid when there are more cells than squares
+        num_cells = rows * cols
+        for i, aid in enumerate(aids):
+            cell = (i * num_cells) // len(aids)
+            row = cell // cols
+            col = cell % cols
+            target_x = x_min + (col + 0.5 + self.jitter * rng.uniform(-0.5, 0.5)) * cell_w - 0.5
+            target_y = y_min + (row + 0.5 + self.jitter * rng.uniform(-0.5, 0.5)) * cell_h - 0.5
+            radius = math.ceil(max(cell_w, cell_h))
+
+            origin = self._nearest_origin(placement, size, target_x, target_y, radius, x_min, y_min, x_max, y_max)
+            if origin is None:
+                stats.count("lattice fallbacks")
+                spaces = placement.candidate_spaces(size, border_basic, border_bottom_x, border_bottom_y)
+                if len(spaces) == 0:
+                    print("ERROR: FAILED TO FIND ALLOCATION FOR SIZE = {} ".format(size))
+                    return False
+
+                squares_of_size = placement.squares_of_size(size)
+                apart = [space for space in spaces if not squares_of_size.has_within(*space)]
+                origin = min(apart if len(apart) > 0 else spaces,
+                             key=lambda c: (c[0] - target_x) ** 2 + (c[1] - target_y) ** 2)
+
+            placement.place_square(aid, origin[0], origin[1], size)
+
+        return True
+
+    @staticmethod
+    def _nearest_origin(placement: Placement, size, target_x, target_y, radius, x_min, y_min, x_max, y_max):
+        # Free origin closest to the target within radius, preferring ones not adjacent to the same size
+        origins = placement.free_origins(size)
+        squares_of_size = placement.squares_of_size(size)
+        cx = min(max(round(target_x), x_min), x_max)
+        cy = min(max(round(target_y), y_min), y_max)
+
+        best = None
+        best_adjacent = None
+        for x in range(max(x_min, cx - radius), min(x_max, cx + radius) + 1):
+            for y in range(max(y_min, cy - radius), min(y_max, cy + radius) + 1):
+                if (x, y) not in origins:
+                    continue
+
+                key = ((x - target_x) ** 2 + (y - target_y) ** 2, x, y)
+                if squares_of_size.has_within(x, y):
+                    if best_adjacent is None or key < best_adjacent:
+                        best_adjacent = key
+                elif best is None or key < best:
+                    best = key
+
+        if best is None:
+            best = best_adjacent
+        if best is None:
+            return None
+        return best[1], best[2]
+
+
+ENGINES = {
+    "random": RandomEngine,
+    "lattice": LatticeEngine,
+}
+
+
+def journal_key(settings: Settings, posters):
+    return hashlib.sha1(repr((sorted(vars(settings).items()), posters)).encode("utf-8")).digest()
+
+
+# With a journal file, an interrupted allocation of the same settings and posters picks up from the last square
+# it placed. The journal is deleted if the allocation dead ends, as replaying it would dead end again
+def do_allocation(settings: Settings, posters, journal_file: str = None, engine=None):
+    if engine is None:
+        engine = RandomEngine()
+
+    placement = Placement(settings.num_along - settings.excess_cols, settings.num_down)
+    if journal_file is not None:
+        placement.resume_journal(journal_file, journal_key(settings, posters))
+
+    try:
+        for size, posters_for_size in enumerate(reversed(posters)):
+            size = len(posters) - size
+            placement.print_placement()
+            stats.log(DEBUG)
+
+            if size == 1:
+                with stats.span("allocate size 1"):
+                    aids = map(lambda p: poster_id(p), posters_for_size)
+                    placement.alloc_all_size_ones([aid for aid in aids if aid not in placement.placements])
+                break
+
+            with stats.span(f"allocate size {size}"):
+                aids = [poster_id(poster) for poster in posters_for_size]
+                aids = [aid for aid in aids if aid not in placement.placements]
+                border = 1 + settings.excess_rows
+                if not engine.place_size(placement, aids, size, 1, border, border):
+                    raise AllocationFailed(f"No room left for the size {size} squares")
+    except AllocationFailed:
+        if journal_file is not None:
+            placement.close_journal()
+            os.remove(journal_file)
+        raise
+    finally:
+        placement.close_journal()
 
     placement.print_placement()
-    print("Remove ones:")
+    stats.log(DEBUG, "Remove ones:")
     placement.remove_final_ones()
     placement.print_placement()
     return placement
 
 
+def evict_for_square(placement: Placement, size, border_basic, border_bottom_x, border_bottom_y, dirty):
+    # Origin for a size x size square that only covers free cells and smaller squares. Prefers origins not adjacent
+    # to the same size, then those displacing the fewest squares above size 1, then the fewest squares overall.
+    # Frees the squares it displaces, adding their cells to dirty, and returns the origin and their
+    # (album id, size), or None if every origin overlaps a square at least as large
+    squares_of_size = placement.squares_of_size(size)
+    best = None
+    for x in range(border_basic, placement.n_x - border_bottom_x - size + 1):
+        for y in range(border_basic, placement.n_y - border_bottom_y - size + 1):
+            owners = placement.region_owners(x, y, x + size, y + size)
+            sizes = [placement.placement_size[aid] for aid in owners]
+            if any(owner_size >= size for owner_size in sizes):
+                continue
+
+            key = (squares_of_size.has_within(x, y), sum(1 for owner_size in sizes if owner_size > 1), len(owners), x, y)
+            if best is None or key < best[0]:
+                best = (key, owners)
+
+    if best is None:
+        return None
+
+    key, owners = best
+    displaced = [(aid, placement.placement_size[aid]) for aid in owners]
+    for aid in owners:
+        dirty.update(placement.cells(aid))
+        placement.free_square(aid)
+    return (key[3], key[4]), displaced
+
+
+# Brings a saved placement up to date with the current posters (as grouped by group_posters) while keeping every
+# album that is still there at the same size where it was. Albums that are gone or changed size are removed.
+# Large squares for new or resized albums go into free space, or displace smaller squares which are then placed
+# again themselves, and finally new and displaced size 1 covers fill the free cells.
+# Returns the set of (x, y) cells that changed and need re-rendering
+def update_allocation(placement: Placement, settings: Settings, posters, engine=None):
+    if engine is None:
+        engine = RandomEngine()
+
+    desired = {}
+    for size_index, posters_for_size in enumerate(posters):
+        for poster in posters_for_size:
+            desired[poster_id(poster)] = size_index + 1
+
+    dirty = set()
+    for aid in list(placement.placements):
+        if desired.get(aid) != placement.placement_size[aid]:
+            dirty.update(placement.cells(aid))
+            placement.free_square(aid)
+            stats.count("albums removed or resized")
+
+    pending = {}  # Size -> album ids still to place
+    for aid in desired:
+        if aid not in placement.placements:
+            pending.setdefault(desired[aid], []).append(aid)
+            stats.count("albums added")
+
+    border = 1 + settings.excess_rows
+    # Largest first, and displaced squares join pending as they go, possibly at a size not seen yet
+    while any(size > 1 and len(aids) > 0 for size, aids in pending.items()):
+        size = max(size for size, aids in pending.items() if len(aids) > 0)
+        aid = pending[size].pop(0)
+        if len(placement.candidate_spaces(size, 1, border, border)) == 0:
+            evicted = evict_for_square(placement, size, 1, border, border, dirty)
+            if evicted is None:
+                raise AllocationFailed(f"No room left for a size {size} square, run a full allocation")
+            for displaced_aid, displaced_size in evicted[1]:
+                pending.setdefault(displaced_size, []).append(displaced_aid)
+            stats.count("squares displaced", len(evicted[1]))
+
+        if not engine.place_size(placement, [aid], size, 1, border, border):
+            raise AllocationFailed(f"No room left for a size {size} square, run a full allocation")
+        dirty.update(placement.cells(aid))
+
+    ones = pending.get(1, [])
+    if placement.places.count(0) < len(ones):
+        raise AllocationFailed("Not enough free cells left, run a full allocation")
+    placement.alloc_all_size_ones(ones)
+    for aid in ones:
+        dirty.update(placement.cells(aid))
+
+    return dirty
+
+
+# Re-renders only the given cells of an existing render: repastes the squares covering them and
+# clears the ones now left empty
+def render_dirty(placement: Placement, settings: Settings, base_dir: str, poster_image: PosterImage, dirty,
+                 tile_cache: TileCache = None):
+    owners = set()
+    for x, y in dirty:
+        aid = placement.owner(x, y)
+        if aid is None:
+            left = x * settings.dim + poster_image.left_margin
+            top = y * settings.dim + poster_image.top_margin
+            poster_image.base.paste("white", (left, top, left + settings.dim, top + settings.dim))
+        else:
+            owners.add(aid)
+
+    for aid in owners:
+        image = load_artwork(base_dir, aid, placement.placement_size[aid], settings, tile_cache)
+        x_row, y_row = placement.placements[aid]
+        poster_image.add_image(image, x_row * settings.dim, y_row * settings.dim)
+
+    stats.log(PROGRESS, f"Re-rendered {len(dirty)} cells, {len(owners)} covers")
+
+
+def nearest_neighbour_distances(points, cell: float):
+    # Distance from each point to its nearest other point, searching outwards ring by ring over a bucket grid
+    buckets = {}
+    for x, y in points:
+        buckets.setdefault((int(x // cell), int(y // cell)), []).append((x, y))
+
+    max_ring = max(max(bx for bx, _ in buckets) - min(bx for bx, _ in buckets),
+                   max(by for _, by in buckets) - min(by for _, by in buckets))
+
+    distances = []
+    for x, y in points:
+        bx = int(x // cell)
+        by = int(y // cell)
+        best = math.inf
+        ring = 0
+        # Points in buckets outside ring r are more than r cells away, so stop once one is closer than that
+        while ring <= max_ring:
+            for nx in range(bx - ring, bx + ring + 1):
+                for ny in range(by - ring, by + ring + 1):
+                    if max(abs(nx - bx), abs(ny - by)) != ring:
+                        continue
+                    for ox, oy in buckets.get((nx, ny), ()):
+                        if (ox, oy) != (x, y):
+                            best = min(best, math.sqrt((ox - x) * (ox - x) + (oy - y) * (oy - y)))
+
+            if best <= ring * cell:
+                break
+            ring += 1
+        distances.append(best)
+
+    return distances
+
+
+# How evenly the large covers are spread, higher is better. For each size above 1 this is the mean
+# nearest neighbour distance divided by what it would be for points scattered at random (the Clark-Evans
+# ratio, about 1 for random, below 1 when clustered), averaged over sizes weighted by count
+def spread_score(placement: Placement):
+    area = placement.n_x * placement.n_y
+    total = 0
+    weight = 0
+    for size in set(placement.placement_size.values()):
+        if size <= 1:
+            continue
+
+        points = [placement.placements[aid] for aid in placement.placements if placement.placement_size[aid] == size]
+        if len(points) < 2:
+            continue
+
+        expected = 0.5 * math.sqrt(area / len(points))
+        distances = nearest_neighbour_distances(points, max(1.0, expected))
+        total += len(points) * (sum(distances) / len(distances)) / expected
+        weight += len(points)
+
+    if weight == 0:
+        return 0
+    return total / weight
+
+
+def allocation_run(job):
+    # For pool workers: one seeded do_allocation, returning None for the placement if it dead-ended
+    settings, posters, seed, engine = job
+    stats.reset()
+    random.seed(seed)
+    if isinstance(engine, LatticeEngine):
+        # Its own generator has to differ between runs too
+        engine = LatticeEngine(engine.jitter, seed)
+    try:
+        placement = do_allocation(settings, posters, engine=engine)
+    except AllocationFailed:
+        return seed, None, None, stats.to_dict()
+
+    # The indexes are only needed while allocating and would make the result slow to send back
+    placement.drop_indexes()
+    return seed, placement, spread_score(placement), stats.to_dict()
+
+
+# Runs do_allocation with different seeds in a process pool and keeps the placement with the best spread_score.
+# Runs that fail are retried with a new seed, up to max_retries in total. If good_enough is given the remaining
+# runs are cancelled as soon as one scores at least that. A LatticeEngine is reseeded for each run, and needs
+# some jitter as otherwise every run places the squares the same
+def do_allocation_multi_start(settings: Settings, posters, runs=8, processes=None, base_seed=0, max_retries=8,
+                              good_enough=None, engine=None):
+    if isinstance(engine, LatticeEngine) and engine.jitter == 0:
+        raise ValueError("Every run of a LatticeEngine without jitter gives the same placement")
+
+    seeds = list(range(base_seed, base_seed + runs))
+    next_seed = base_seed + runs
+    retries = 0
+    best_seed, best, best_score = None, None, -math.inf
+
+    with multiprocessing.Pool(processes) as pool:
+        while len(seeds) > 0:
+            failed = 0
+            for seed, placement, score, worker_stats in pool.imap_unordered(
+                    allocation_run, [(settings, posters, seed, engine) for seed in seeds]):
+                stats.merge(worker_stats)
+                if placement is None:
+                    stats.count("failed allocation runs")
+                    stats.log(PROGRESS, f"Allocation with seed {seed} failed")
+                    failed += 1
+                    continue
+
+                stats.log(PROGRESS, f"Allocation with seed {seed} scored {score:.3f}")
+                if score > best_score:
+                    best_seed, best, best_score = seed, placement, score
+
+                if good_enough is not None and best_score >= good_enough:
+                    break
+
+            if good_enough is not None and best_score >= good_enough:
+                # Leaving the with block terminates the runs still going
+                break
+
+            failed = min(failed, max_retries - retries)
+            retries += failed
+            seeds = list(range(next_seed, next_seed + failed))
+            next_seed += failed
+
+    if best is None:
+        raise AllocationFailed("All allocation runs failed")
+
+    stats.log(PROGRESS, f"Using allocation with seed {best_seed}, score {best_score:.3f}")
+    return best
+
+
+def apportion(count, weights):
+    # Splits count into whole shares proportional to weights, largest remainders rounded up
+    total = sum(weights)
+    if total == 0:
+        return [0] * len(weights)
+
+    shares = [count * weight / total for weight in weights]
+    quotas = [int(share) for share in shares]
+    by_remainder = sorted(range(len(weights)), key=lambda i: quotas[i] - shares[i])
+    for i in by_remainder[:count - sum(quotas)]:
+        quotas[i] += 1
+    return quotas
+
+
+def region_origins(bounds, size, n_x, n_y, border):
+    # Number of origins in the region a square of this size could use on the full grid
+    x0, y0, x1, y1 = bounds
+    width = min(x1, n_x - border) - max(x0, 1) - size + 1
+    height = min(y1, n_y - border) - max(y0, 1) - size + 1
+    return max(0, width) * max(0, height)
+
+
+def allocate_region(job):
+    # For pool workers: places the squares given for one region on a Placement of just that region, returning
+    # them in full grid coordinates along with the album ids that didn't fit
+    index, bounds, n_x, n_y, border, work, seed, engine_name = job
+    stats.reset()
+    random.seed(seed)
+    x0, y0, x1, y1 = bounds
+    region = Placement(x1 - x0, y1 - y0)
+    engine = ENGINES[engine_name]()
+
+    # Large squares can't cover the first row and column or the border at the bottom and right of the full grid
+    for x in range(x0, x1):
+        for y in range(y0, y1):
+            if not (1 <= x < n_x - border and 1 <= y < n_y - border):
+                region.alloc(x - x0, y - y0, BLOCKED)
+
+    records = []
+    unplaced = []
+    for size, aids in work:
+        engine.place_size(region, aids, size, 0, 0, 0)
+        for aid in aids:
+            if aid in region.placements:
+                x, y = region.placements[aid]
+                records.append((aid, x + x0, y + y0, size))
+            else:
+                unplaced.append((aid, size))
+
+    return index, records, unplaced, stats.to_dict()
+
+
+def repair_seams(placement: Placement, region_of):
+    # Frees squares adjacent to a square of the same size from another region, which the regions couldn't
+    # see. Returns the freed album ids by size
+    freed = {}
+    for size in sorted(set(placement.placement_size.values()), reverse=True):
+        if size == 1:
+            continue
+
+        cell = adjacency_reach(size) + 1
+        kept = {}  # Bucket -> [(aid, origin)] of squares staying where they are
+        for aid in [aid for aid in placement.placements if placement.placement_size[aid] == size]:
+            origin = placement.placements[aid]
+            bx, by = origin[0] // cell, origin[1] // cell
+            conflict = False
+            for nx in range(bx - 1, bx + 2):
+                for ny in range(by - 1, by + 2):
+                    for other, other_origin in kept.get((nx, ny), []):
+                        if region_of[other] != region_of[aid] and placement.are_adjacent(origin, other_origin, size):
+                            conflict = True
+
+            if conflict:
+                freed.setdefault(size, []).append(aid)
+            else:
+                kept.setdefault((bx, by), []).append((aid, origin))
+
+    for aids in freed.values():
+        for aid in aids:
+            placement.free_square(aid)
+    return freed
+
+
+# Splits the grid into regions_x by regions_y regions and gives each a share of every size of square, in
+# proportion to the room it has for that size. Regions are allocated at the same time in a process pool, each
+# under the same border and adjacency rules as do_allocation but blind to its neighbours. So afterwards squares
+# next to one of their size across a region boundary, and any a region couldn't fit, are placed again on the
+# full grid, before the size ones fill what is left. For grids too large for do_allocation to place one square
+# at a time
+def do_allocation_regions(settings: Settings, posters, regions_x=4, regions_y=4, processes=None, seed=0,
+                          engine_name="random"):
+    n_x = settings.num_along - settings.excess_cols
+    n_y = settings.num_down
+    border = 1 + settings.excess_rows
+    xs = [n_x * i // regions_x for i in range(regions_x + 1)]
+    ys = [n_y * j // regions_y for j in range(regions_y + 1)]
+    regions = [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for j in range(regions_y) for i in range(regions_x)]
+
+    work = [[] for _ in regions]
+    for size in range(len(posters), 1, -1):
+        aids = [poster_id(poster) for poster in posters[size - 1]]
+        quotas = apportion(len(aids), [region_origins(bounds, size, n_x, n_y, border) for bounds in regions])
+        start = 0
+        for i, quota in enumerate(quotas):
+            if quota > 0:
+                work[i].append((size, aids[start:start + quota]))
+            start += quota
+
+    jobs = [(i, bounds, n_x, n_y, border, work[i], seed + i, engine_name) for i, bounds in enumerate(regions)]
+    placement = Placement(n_x, n_y)
+    region_of = {}
+    retry = {}
+    with stats.span("allocate regions"), multiprocessing.Pool(processes) as pool:
+        for index, records, unplaced, worker_stats in pool.imap_unordered(allocate_region, jobs):
+            stats.merge(worker_stats)
+            for aid, x, y, size in records:
+                placement.place_square(aid, x, y, size)
+                region_of[aid] = index
+            for aid, size in unplaced:
+                retry.setdefault(size, []).append(aid)
+
+    with stats.span("repair seams"):
+        random.seed(seed)
+        moved = repair_seams(placement, region_of)
+        stats.count("seam conflicts", sum(len(aids) for aids in moved.values()))
+        stats.count("region overflows", sum(len(aids) for aids in retry.values()))
+        engine = ENGINES[engine_name]()
+        for size in sorted(set(retry) | set(moved), reverse=True):
+            aids = moved.get(size, []) + retry.get(size, [])
+            if not engine.place_size(placement, aids, size, 1, border, border):
+                raise AllocationFailed(f"No room left to place the size {size} squares again")
+
+    with stats.span("allocate size 1"):
+        placement.alloc_all_size_ones([poster_id(poster) for poster in posters[0]])
+    placement.remove_final_ones()
+    return placement
+
+
+def render_serial(placement: Placement, settings: Settings, base_dir: str, poster_image: PosterImage,
+                  tile_cache: TileCache = None):
+    i = 0
+    N = len(placement.placements.keys())
+    for aid in placement.placements:
+        i += 1
+        image = load_artwork(base_dir, aid, placement.placement_size[aid], settings, tile_cache)
+        x_row, y_row = placement.placements[aid]
+        x = x_row * settings.dim
+        y = y_row * settings.dim
+        poster_image.add_image(image, x, y)
+        if i % 10 == 0:
+            stats.log(PROGRESS, f"{int(100 * i / N)}% Placing images")
+
+
+# Decodes and resizes covers on worker threads (PIL releases the GIL for both) while this thread pastes them.
+# At most queue_size resized covers wait to be pasted, so memory stays flat however many albums there are.
+# Draws the same pixels as render_serial unless reduced is passed
+def render_pipelined(placement: Placement, settings: Settings, base_dir: str, poster_image: PosterImage,
+                     workers=4, queue_size=64, tile_cache: TileCache = None, reduced=False):
+    work = queue.Queue()
+    for aid in placement.placements:
+        work.put(aid)
+    ready = queue.Queue(maxsize=queue_size)
+
+    def produce():
+        while True:
+            try:
+                aid = work.get_nowait()
+            except queue.Empty:
+                ready.put(None)
+                return
+
+            try:
+                image = load_artwork(base_dir, aid, placement.placement_size[aid], settings, tile_cache, reduced)
+            except Exception as e:
+                ready.put(e)
+                return
+            ready.put((aid, image))
+
+    for _ in range(workers):
+        threading.Thread(target=produce, daemon=True).start()
+
+    i = 0
+    N = len(placement.placements)
+    finished = 0
+    while finished < workers:
+        item = ready.get()
+        if item is None:
+            finished += 1
+            continue
+        if isinstance(item, Exception):
+            raise item
+
+        aid, image = item
+        x_row, y_row = placement.placements[aid]
+        poster_image.add_image(image, x_row * settings.dim, y_row * settings.dim)
+        i += 1
+        if i % 10 == 0:
+            stats.log(PROGRESS, f"{int(100 * i / N)}% Placing images")
+
+
+def render_band(job) -> Image:
+    # Renders the rows [y_start, y_end) of the poster, pasting only the squares that intersect them.
+    # Runs in a worker process, so takes one picklable tuple
+    base_dir, settings, width, left_margin, top_margin, y_start, y_end, squares, tile_cache = job
+    band = Image.new("RGB", (width, y_end - y_start), "white")
+    for aid, x_row, y_row, size in squares:
+        image = load_artwork(base_dir, aid, size, settings, tile_cache)
+        with stats.span("paste"):
+            band.paste(image, (x_row * settings.dim + left_margin, y_row * settings.dim + top_margin - y_start))
+
+    return band
+
+
+def render_band_with_stats(job):
+    # For pool workers: returns the band along with the spans and counters recorded while rendering it
+    stats.reset()
+    band = render_band(job)
+    return band, stats.to_dict()
+
+
+def band_job(placement: Placement, settings: Settings, base_dir: str, width, left_margin, top_margin,
+             y_start, y_end, tile_cache: TileCache = None):
+    squares = []
+    for aid in placement.placements:
+        x_row, y_row = placement.placements[aid]
+        size = placement.placement_size[aid]
+        top = y_row * settings.dim + top_margin
+        bottom = top + size * settings.dim
+        if top < y_end and bottom > y_start:
+            squares.append((aid, x_row, y_row, size))
+
+    return base_dir, settings, width, left_margin, top_margin, y_start, y_end, squares, tile_cache
+
+
+def band_jobs(placement: Placement, settings: Settings, base_dir: str, poster_image: PosterImage, num_bands: int,
+              tile_cache: TileCache = None):
+    band_height = math.ceil(poster_image.height / num_bands)
+    jobs = []
+    for y_start in range(0, poster_image.height, band_height):
+        y_end = min(y_start + band_height, poster_image.height)
+        jobs.append(band_job(placement, settings, base_dir, poster_image.width, poster_image.left_margin,
+                             poster_image.top_margin, y_start, y_end, tile_cache))
+
+    return jobs
+
+
+# Squares never overlap, so each band comes out the same as that slice of the serial render.
+# Squares crossing a band boundary are decoded once for each band they touch
+def render_parallel(placement: Placement, settings: Settings, base_dir: str, poster_image: PosterImage,
+                    num_bands=64, processes=None, tile_cache: TileCache = None):
+    jobs = band_jobs(placement, settings, base_dir, poster_image, num_bands, tile_cache)
+    with multiprocessing.Pool(processes) as pool:
+        for i, (band, worker_stats) in enumerate(pool.imap(render_band_with_stats, jobs)):
+            poster_image.paste(band, 0, jobs[i][5])
+            stats.merge(worker_stats)
+            stats.log(PROGRESS, f"{int(100 * (i + 1) / len(jobs))}% Rendering bands")
+
+
+# Same output as add_safety_margin on the full render, but composited and encoded a strip at a time
+# so only one strip of the canvas is ever in memory
+# With deep_zoom_file, the same strips also go to a tile pyramid of the image
+def stream_poster(placement: Placement, settings: Settings, base_dir: str, width, height, left_margin, top_margin,
+                  file: str, safety_px=0, strip_height=256, tile_cache: TileCache = None, deep_zoom_file: str = None,
+                  compress_level=6, encode_processes=1):
+    out_width = width + safety_px * 2
+    out_height = height + safety_px * 2
+    with contextlib.ExitStack() as writers:
+        writer = writers.enter_context(png_writer(file, out_width, out_height, compress_level, encode_processes))
+        zoom_writer = None
+        if deep_zoom_file is not None:
+            zoom_writer = writers.enter_context(DeepZoomWriter(deep_zoom_file, out_width, out_height))
+
+        for out_start in range(0, out_height, strip_height):
+            out_end = min(out_start + strip_height, out_height)
+            strip = Image.new("RGB", (out_width, out_end - out_start), "white")
+
+            # Rows of the poster itself covered by this strip, the rest is safety margin
+            y_start = max(0, out_start - safety_px)
+            y_end = min(height, out_end - safety_px)
+            if y_start < y_end:
+                band = render_band(band_job(placement, settings, base_dir, width, left_margin, top_margin,
+                                            y_start, y_end, tile_cache))
+                strip.paste(band, (safety_px, y_start + safety_px - out_start))
+
+            with stats.span("save"):
+                writer.write_strip(strip)
+            if zoom_writer is not None:
+                with stats.span("deep zoom"):
+                    zoom_writer.write_strip(strip)
+            stats.log(PROGRESS, f"{int(100 * out_end / out_height)}% Writing strips")
+
+
 # 165
 def add_safety_margin(image: Image, width, height, px) -> Image:
     new_image = Image.new("RGB", (width + px * 2, height + px * 2), "white")
@@ -435,70 +1386,217 @@ def add_safety_margin(image: Image, width, height, px) -> Image:
 
 
 def main():
-    image = Image.open("out-final-raw.png")
-    safety = add_safety_margin(image, 14043, 9933, 165)
-    print("Saving")
-    safety.save("out-final-raw-safe.png")
-    return
+    stats.verbosity = PROGRESS
 
-    freq = album_frequency()
-    brackets = get_brackets(freq)
+    # e.g. datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc) for a poster of a single year
+    history_start = None
+    history_end = None
 
     do_alloc = True
+    update_placement = False  # Keep use_placement and only fit in new or resized albums, patching out.png
+    allocation_runs = 1  # More than one picks the best spread of that many seeded allocations
+    allocation_regions = None  # e.g. (4, 4) allocates that grid of regions in parallel, for very large posters
+    engine_name = "random"  # "lattice" places the large covers deterministically and much faster
+    engine = ENGINES[engine_name]()  # With allocation_runs, the lattice needs jitter: LatticeEngine(jitter=0.5)
     use_placement = "placements/2019-2-12 10:18:32"
+    # "serial", "parallel", "pipelined" (decode on threads ahead of pasting) or "stream" (strip by strip to disk)
+    render_mode = "parallel"
+    # "image" (PIL), "array" (numpy, batched pastes) or "memmap" (numpy backed by canvas.raw, for canvases
+    # bigger than memory). Incremental updates always patch out.png as an image
+    canvas = "image"
+    safety_px = 165
+    deep_zoom = False  # Also write out.dzi and out_files/, a tile pyramid for browsing the poster on screen
+    compress_level = 6  # zlib level for the PNGs, 1 is fastest and 9 smallest
+    encode_processes = None  # Compress the PNGs on this many processes, None for all cores and 1 for PIL's encoder
+    tile_cache = TileCache("tile-cache")
 
     base_dir = "artwork"
+    use_atlas = False  # Read covers from artwork.atlas instead of the files, packed or updated for this poster
     canvas_height = 9933
     canvas_width = 14043
 
     # canvas_height = 1000
     # canvas_width = 1400
 
+    # Rerun only what changed since the last run, ignoring do_alloc, use_placement and update_placement
+    use_pipeline = False
+
+    if use_pipeline:
+        if use_atlas:
+            base_dir = Atlas(f"{base_dir}.atlas")
+        poster_pipeline(base_dir, history.TRACKS_FILE, history_start, history_end, canvas_width, canvas_height,
+                        engine_name, 0, render_mode, canvas, safety_px, deep_zoom, tile_cache, compress_level,
+                        encode_processes).run()
+        finish_stats()
+        return
+
+    freq = album_frequency(history_start, history_end)
+    with stats.span("brackets"):
+        brackets = get_brackets(freq)
     files = get_files(base_dir)
+    if history_start is not None or history_end is not None:
+        files = played_files(files, freq)
 
     N_posters = len(files)
 
-    posters = [[], [], []]
-    counts = [0, 0, 0]
-
-    for file in files:
-        aid = poster_id(file)
-        size = get_size(freq, brackets, aid)
-        posters[size - 1].append(file)
-        counts[size - 1] += 1
-
-    posters = [posters[0], posters[1], [], posters[2]]
+    posters, sizes = group_posters(files, freq, brackets)
+    with stats.span("settings"):
+        if update_placement and not do_alloc:
+            # Has to stay on the grid the placement was made for
+            settings = load_settings(f"{use_placement}.settings")
+        else:
+            settings = compute_settings(N_posters, canvas_width, canvas_height, sizes)
+    left_margin = int(settings.right_margin_px / 2)
+    top_margin = int(settings.bottom_margin_px / 2)
 
-    settings = compute_settings(N_posters, canvas_width, canvas_height,
-                                [(1, counts[0]), (2, counts[1]), (4, counts[2])])
-    poster_image = PosterImage(canvas_width, canvas_height, int(settings.right_margin_px / 2),
-                               int(settings.bottom_margin_px / 2))
+    if use_atlas:
+        # Level 0 at the largest square's px, so the atlas holds no more pixels than the poster can show
+        with stats.span("atlas"):
+            build_atlas(base_dir, f"{base_dir}.atlas", settings.dim * len(posters))
+        base_dir = Atlas(f"{base_dir}.atlas")
 
     # Remove small number of albums we can't fit exactly in one square
     # Not yet sorted so we are removing posters with smallest num. of plays
     # posters[0] = posters[0][settings.num_in_incomplete_row:]
-    if do_alloc:
-        placement = do_allocation(settings, posters)
-        placement.save_with_datetime("placements/")
+    dirty = None
+    if do_alloc and allocation_regions is not None:
+        placement = do_allocation_regions(settings, posters, *allocation_regions, engine_name=engine_name)
+        save_settings(settings, f"{placement.save_with_datetime('placements/')}.settings")
+    elif do_alloc and allocation_runs > 1:
+        placement = do_allocation_multi_start(settings, posters, allocation_runs, engine=engine)
+        save_settings(settings, f"{placement.save_with_datetime('placements/')}.settings")
+    elif do_alloc:
+        placement = do_allocation(settings, posters, "placements/journal", engine)
+        save_settings(settings, f"{placement.save_with_datetime('placements/')}.settings")
+        os.remove("placements/journal")
     else:
         placement = Placement(0, 0)
         placement.load(use_placement)
+        if update_placement:
+            dirty = update_allocation(placement, settings, posters, engine)
+            save_settings(settings, f"{placement.save_with_datetime('placements/')}.settings")
+
+    if dirty is not None and render_mode != "stream" and os.path.exists("out.png"):
+        poster_image = PosterImage.from_file("out.png", left_margin, top_margin)
+        render_dirty(placement, settings, base_dir, poster_image, dirty, tile_cache)
+        poster_image.save(compress_level=compress_level, processes=encode_processes)
+        if safety_px > 0:
+            poster_image.save("out-safe.png", safety_px, compress_level, encode_processes)
+        if deep_zoom:
+            poster_image.save_deep_zoom()
+        finish_stats()
+        return
+
+    render_poster(placement, settings, base_dir, canvas_width, canvas_height, render_mode, canvas, safety_px,
+                  deep_zoom, tile_cache, compress_level, encode_processes)
+    finish_stats()
+
+
+# Renders and writes out.png, out-safe.png if safety_px is above 0 (only the one of them when streaming) and
+# the deep zoom pyramid. Returns the files written
+def render_poster(placement: Placement, settings: Settings, base_dir: str, canvas_width, canvas_height,
+                  render_mode="parallel", canvas="image", safety_px=0, deep_zoom=False, tile_cache: TileCache = None,
+                  compress_level=6, encode_processes=1):
+    left_margin = int(settings.right_margin_px / 2)
+    top_margin = int(settings.bottom_margin_px / 2)
+    files = ["out.dzi"] if deep_zoom else []
+
+    if render_mode == "stream":
+        # Only the one file, with the margin if there is one
+        file = "out-safe.png" if safety_px > 0 else "out.png"
+        stream_poster(placement, settings, base_dir, canvas_width, canvas_height, left_margin, top_margin,
+                      file, safety_px, tile_cache=tile_cache, deep_zoom_file="out.dzi" if deep_zoom else None,
+                      compress_level=compress_level, encode_processes=encode_processes)
+        return [file] + files
+
+    if canvas == "array":
+        poster_image = ArrayCanvas(canvas_width, canvas_height, left_margin, top_margin)
+    elif canvas == "memmap":
+        poster_image = ArrayCanvas(canvas_width, canvas_height, left_margin, top_margin, "canvas.raw")
+    else:
+        poster_image = PosterImage(canvas_width, canvas_height, left_margin, top_margin)
+    if render_mode == "parallel":
+        render_parallel(placement, settings, base_dir, poster_image, tile_cache=tile_cache)
+    elif render_mode == "pipelined":
+        render_pipelined(placement, settings, base_dir, poster_image, tile_cache=tile_cache)
+    else:
+        render_serial(placement, settings, base_dir, poster_image, tile_cache)
+
+    stats.log(PROGRESS, "Done - saving")
+    poster_image.save(compress_level=compress_level, processes=encode_processes)
+    files = ["out.png"] + files
+    if safety_px > 0:
+        # PosterImage builds a second full size canvas for this
+        poster_image.save("out-safe.png", safety_px, compress_level, encode_processes)
+        files.append("out-safe.png")
+    if deep_zoom:
+        poster_image.save_deep_zoom()
+    return files
+
+
+def file_stamps(files):
+    return {file: (os.stat(file).st_size, os.stat(file).st_mtime_ns) for file in files}
+
+
+def stamps_match(stamps):
+    return all(os.path.exists(file) and file_stamps([file])[file] == stamp for file, stamp in stamps.items())
+
+
+# The same steps as main as a Pipeline, so a rerun only repeats the stages whose inputs changed:
+#   frequency  album play counts in the date range, from the listening history
+#   files      the artwork files
+#   brackets   play count thresholds for each square size
+#   layout     settings for the canvas, and the artwork grouped by square size
+#   placement  the allocation, seeded
+#   render     the output images, rerun if they were changed or deleted since
+def poster_pipeline(base_dir="artwork", tracks_file=history.TRACKS_FILE, history_start: datetime.datetime = None,
+                    history_end: datetime.datetime = None, canvas_width=14043, canvas_height=9933, engine="random",
+                    seed=0, render_mode="parallel", canvas="image", safety_px=165, deep_zoom=False,
+                    tile_cache: TileCache = None, compress_level=6, encode_processes=1,
+                    cache_dir="pipeline-cache") -> Pipeline:
+    pipeline = Pipeline(cache_dir)
+    pipeline.file_source("plays", tracks_file, lambda: history.HistoryStore.load(tracks_file))
+    if isinstance(base_dir, Atlas):
+        pipeline.file_source("files", base_dir.file, lambda: get_files(base_dir))
+    else:
+        pipeline.directory_source("files", base_dir, lambda: get_files(base_dir), ".png")
+
+    pipeline.add("frequency", lambda store, start, end: store.album_counts(start, end), ["plays"],
+                 start=history_start, end=history_end)
+    pipeline.add("brackets", get_brackets, ["frequency"])
+
+    def layout(files, freq, brackets, width, height, played_only):
+        if played_only:
+            files = played_files(files, freq)
+        posters, sizes = group_posters(files, freq, brackets)
+        return compute_settings(len(files), width, height, sizes), posters
+
+    pipeline.add("layout", layout, ["files", "frequency", "brackets"], width=canvas_width, height=canvas_height,
+                 played_only=history_start is not None or history_end is not None)
+
+    def allocate(layout, engine, seed):
+        random.seed(seed)
+        placement = do_allocation(layout[0], layout[1], engine=ENGINES[engine]())
+        placement.drop_indexes()
+        return placement
+
+    pipeline.add("placement", allocate, ["layout"], engine=engine, seed=seed)
+
+    def render(placement, layout, files, **options):
+        return file_stamps(render_poster(placement, layout[0], base_dir, canvas_width, canvas_height,
+                                         tile_cache=tile_cache, **options))
+
+    # Covers are read by the render, so it depends on them directly and not just through the layout
+    pipeline.add("render", render, ["placement", "layout", "files"], check=stamps_match, render_mode=render_mode,
+                 canvas=canvas, safety_px=safety_px, deep_zoom=deep_zoom, compress_level=compress_level,
+                 encode_processes=encode_processes)
+    return pipeline
 
-    i = 0
-    N = len(placement.placements.keys())
-    for aid in placement.placements:
-        i += 1
-        image = Image.open(f"{base_dir}/{aid}.png")
-        image = resize_for_size(image, placement.placement_size[aid], settings)
-        x_row, y_row = placement.placements[aid]
-        x = x_row * settings.dim
-        y = y_row * settings.dim
-        poster_image.add_image(image, x, y)
-        if i % 10 == 0:
-            print(f"{int(100 * i / N)}% Placing images")
 
-    print("Done - saving")
-    poster_image.save()
+def finish_stats():
+    stats.save("stats.json")
+    if stats.enabled(PROGRESS):
+        stats.report()
 
 
 if __name__ == "__main__": main()
@@ -0,0 +1,75 @@
+import contextlib
+import json
+import threading
+import time
+
+QUIET = 0  # Errors only
+PROGRESS = 1  # Stage progress and the settings report
+DEBUG = 2  # Per-placement output and grid dumps
+
+
+# Named timing spans and counters for the whole run, plus verbosity controlled logging.
+# Use the module level stats instance rather than creating another
+class Stats:
+
+    def __init__(self):
+        self.verbosity = PROGRESS
+        self.spans = {}  # Name -> {"calls": n, "seconds": total}
+        self.counters = {}
+        self.lock = threading.Lock()  # Render threads record into the same stats
+
+    def reset(self):
+        self.spans = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = {"calls": 0, "seconds": 0.0}
+            self.spans[name]["calls"] += 1
+            self.spans[name]["seconds"] += seconds
+
+    def count(self, name: str, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        # Adds spans and counters collected elsewhere, e.g. returned from a worker process
+        for name, span in other["spans"].items():
+            if name not in self.spans:
+                self.spans[name] = {"calls": 0, "seconds": 0.0}
+            self.spans[name]["calls"] += span["calls"]
+            self.spans[name]["seconds"] += span["seconds"]
+        for name, n in other["counters"].items():
+            self.count(name, n)
+
+    def enabled(self, level: int):
+        return self.verbosity >= level
+
+    def log(self, level: int, *args, **kwargs):
+        if self.verbosity >= level:
+            print(*args, **kwargs)
+
+    def to_dict(self):
+        return {"spans": self.spans, "counters": self.counters}
+
+    def save(self, file: str):
+        with open(file, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self):
+        for name, span in sorted(self.spans.items(), key=lambda item: -item[1]["seconds"]):
+            print(f"{name:>24} {span['seconds']:10.3f}s {span['calls']:>8} calls")
+        for name, n in sorted(self.counters.items()):
+            print(f"{name:>24} {n:>10}")
+
+
+stats = Stats()
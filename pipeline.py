@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import pickle
+from instrument import stats, PROGRESS
+
+
+def _sha1(data: bytes):
+    return hashlib.sha1(data).hexdigest()
+
+
+# A step of the pipeline: fn(*values of inputs, **params) -> value.
+# check, if given, is asked whether a cached value is still good, e.g. that files it names still exist
+class Stage:
+
+    def __init__(self, name: str, fn, inputs=(), params=None, check=None):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.check = check
+
+
+# Runs stages in the order they were added, each only if it is stale.
+# A stage's key is a hash of its name, parameters and the content hashes of its inputs' values, and its value
+# is cached on disk under that key along with the hash of the value itself. So a stage reruns only when
+# something it depends on actually changed: a new canvas size that works out to the same settings doesn't
+# rerun allocation. Cached values are only loaded when a stale stage needs them as inputs
+class Pipeline:
+
+    def __init__(self, cache_dir="pipeline-cache"):
+        self.cache_dir = cache_dir
+        self.stages = []
+        self.sources = {}  # Name -> function that loads its value
+        self.hashes = {}  # Name -> content hash of the value
+        self.values = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Inputs from outside, hashed up front. The value is only loaded if a stage needs it
+    def source(self, name: str, content_hash: str, load):
+        self.hashes[name] = content_hash
+        self.sources[name] = load
+
+    def file_source(self, name: str, file: str, load):
+        self.source(name, self.file_hash(file), load)
+
+    def directory_source(self, name: str, directory: str, load, suffix=""):
+        # Names, sizes and modification times of the directory's files, much cheaper than reading them
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(suffix):
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        self.source(name, _sha1(repr(sorted(entries)).encode("utf-8")), load)
+
+    def add(self, name: str, fn, inputs=(), check=None, **params):
+        self.stages.append(Stage(name, fn, inputs, params, check))
+
+    def file_hash(self, file: str):
+        # Hashing a large file every run would cost most of a run that has nothing to do, so the hash is
+        # remembered against the file's size and modification time
+        memo_file = os.path.join(self.cache_dir, "file-hashes.json")
+        memo = {}
+        if os.path.exists(memo_file):
+            with open(memo_file) as f:
+                memo = json.load(f)
+
+        stat = os.stat(file)
+        stamp = f"{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}"
+        if stamp not in memo:
+            with stats.span("hash"):
+                digest = hashlib.sha1()
+                with open(file, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+            memo[stamp] = digest.hexdigest()
+            with open(memo_file, "w") as f:
+                json.dump(memo, f)
+
+        return memo[stamp]
+
+    def _key(self, stage: Stage):
+        parts = [stage.name, repr(sorted(stage.params.items()))] + [self.hashes[name] for name in stage.inputs]
+        return _sha1("|".join(parts).encode("utf-8"))
+
+    def _paths(self, stage: Stage, key: str):
+        base = os.path.join(self.cache_dir, f"{stage.name}-{key}")
+        return f"{base}.pickle", f"{base}.hash"
+
+    def value(self, name: str):
+        if name not in self.values:
+            if name in self.sources:
+                self.values[name] = self.sources[name]()
+            else:
+                stage = next(stage for stage in self.stages if stage.name == name)
+                with open(self._paths(stage, self._key(stage))[0], "rb") as f:
+                    self.values[name] = pickle.load(f)
+        return self.values[name]
+
+    def _cached_hash(self, stage: Stage, key: str):
+        value_file, hash_file = self._paths(stage, key)
+        if not os.path.exists(hash_file) or not os.path.exists(value_file):
+            return None
+        if stage.check is not None and not stage.check(self.value(stage.name)):
+            self.values.pop(stage.name, None)
+            return None
+        with open(hash_file) as f:
+            return f.read()
+
+    # Returns the names of the stages that ran
+    def run(self):
+        ran = []
+        for stage in self.stages:
+            key = self._key(stage)
+            content_hash = self._cached_hash(stage, key)
+            if content_hash is not None:
+                stats.count("pipeline stages cached")
+                stats.log(PROGRESS, f"{stage.name}: up to date")
+                self.hashes[stage.name] = content_hash
+                continue
+
+            stats.log(PROGRESS, f"{stage.name}: running")
+            with stats.span(f"stage {stage.name}"):
+                value = stage.fn(*[self.value(name) for name in stage.inputs], **stage.params)
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            content_hash = _sha1(data)
+
+            value_file, hash_file = self._paths(stage, key)
+            with open(f"{value_file}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{value_file}.tmp", value_file)
+            with open(hash_file, "w") as f:
+                f.write(content_hash)
+
+            self.values[stage.name] = value
+            self.hashes[stage.name] = content_hash
+            ran.append(stage.name)
+
+        return ran
@@ -0,0 +1,121 @@
+import mmap
+import os
+import struct
+
+# Binary placement file:
+#   header    magic, version, n_x, n_y, number of album ids, number of records
+#   id table  for each album id, its utf-8 length (u16) then the bytes
+#   records   fixed size (x, y, size, index into the id table), so they can be read straight from an mmap
+MAGIC = b"MPPL"
+VERSION = 1
+HEADER = struct.Struct("<4sHIIII")
+ID_LENGTH = struct.Struct("<H")
+RECORD = struct.Struct("<IIII")
+
+# Journal of placements made during allocation, appended to as each square is placed:
+#   header    magic, version, n_x, n_y, key (20 bytes, a hash of what was being allocated)
+#   records   (x, y, size, id length) then the id bytes
+JOURNAL_MAGIC = b"MPJL"
+JOURNAL_VERSION = 2
+JOURNAL_HEADER = struct.Struct("<4sHII20s")
+JOURNAL_RECORD = struct.Struct("<IIIH")
+
+
+def is_placement_file(file: str):
+    with open(file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_placement(file: str, n_x, n_y, placements, placement_size):
+    ids = []
+    id_index = {}
+    records = []
+    for aid in placements:
+        if aid not in id_index:
+            id_index[aid] = len(ids)
+            ids.append(aid)
+        x, y = placements[aid]
+        records.append(RECORD.pack(x, y, placement_size[aid], id_index[aid]))
+
+    parts = [HEADER.pack(MAGIC, VERSION, n_x, n_y, len(ids), len(records))]
+    for aid in ids:
+        encoded = aid.encode("utf-8")
+        parts.append(ID_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    parts.extend(records)
+
+    tmp_file = f"{file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(b"".join(parts))
+    os.replace(tmp_file, file)
+
+
+# Returns n_x, n_y and a list of (aid, x, y, size)
+def read_placement(file: str):
+    with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, n_x, n_y, num_ids, num_records = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file} is not a version {VERSION} placement file")
+
+        offset = HEADER.size
+        ids = []
+        for _ in range(num_ids):
+            length, = ID_LENGTH.unpack_from(data, offset)
+            offset += ID_LENGTH.size
+            ids.append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+
+        records = []
+        for i in range(num_records):
+            x, y, size, index = RECORD.unpack_from(data, offset + i * RECORD.size)
+            records.append((ids[index], x, y, size))
+
+    return n_x, n_y, records
+
+
+class PlacementJournal:
+
+    def __init__(self, file: str, n_x, n_y, key: bytes):
+        new = not os.path.exists(file)
+        self.out = open(file, "ab")
+        if new:
+            self.out.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, n_x, n_y, key))
+            self.out.flush()
+
+    def write(self, aid: str, x, y, size):
+        encoded = aid.encode("utf-8")
+        self.out.write(JOURNAL_RECORD.pack(x, y, size, len(encoded)) + encoded)
+        # Flush each record so a crash loses at most the square being placed
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+
+# Returns n_x, n_y, the key and the (aid, x, y, size) records in the order they were placed.
+# A record cut short by a crash is dropped, and the file is truncated back to the last whole record
+def read_journal(file: str):
+    with open(file, "rb") as f:
+        data = f.read()
+
+    if len(data) < JOURNAL_HEADER.size:
+        raise ValueError(f"{file} is not a version {JOURNAL_VERSION} placement journal")
+    magic, version, n_x, n_y, key = JOURNAL_HEADER.unpack_from(data, 0)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+        raise ValueError(f"{file} is not a version {JOURNAL_VERSION} placement journal")
+
+    records = []
+    offset = JOURNAL_HEADER.size
+    while offset + JOURNAL_RECORD.size <= len(data):
+        x, y, size, length = JOURNAL_RECORD.unpack_from(data, offset)
+        end = offset + JOURNAL_RECORD.size + length
+        if end > len(data):
+            break
+        records.append((data[offset + JOURNAL_RECORD.size:end].decode("utf-8"), x, y, size))
+        offset = end
+
+    if offset < len(data):
+        with open(file, "r+b") as f:
+            f.truncate(offset)
+
+    return n_x, n_y, key, records
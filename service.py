@@ -0,0 +1,391 @@
+# Long running render service. The history, settings, placement and resized covers stay in memory between
+# requests, so previews and crops while tuning a layout don't pay for a cold start every time:
+#
+#   python service.py serve --port 8765
+#   python service.py get "/preview?width=1400" preview.png
+#   python service.py get "/crop?x=2000&y=1500&w=1000&h=800&scale=0.5" crop.png
+#   python service.py post /render '{"render_mode": "parallel", "safety_px": 165}'
+#   python service.py get /jobs/1
+#   python service.py get /status
+#   python service.py post /invalidate
+#
+# Inputs are checked before each request: a changed history reloads it and recomputes everything after it, a
+# changed artwork directory or atlas also drops the cached covers, and a changed placement file is reloaded.
+# Full renders run in a background process pool and write out.png (and out-safe.png) as image.py does
+from PIL import Image
+import argparse
+import asyncio
+import concurrent.futures
+import copy
+import http.client
+import io
+import json
+import os
+import random
+import sys
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+import history
+import image
+from atlas import Atlas
+from compute import compute_settings, load_settings
+from instrument import stats, PROGRESS
+
+PORT = 8765
+
+
+def stamp(path: str):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def artwork_stamp(base_dir: str):
+    # An atlas is rewritten as a whole. A directory's own mtime doesn't change when a cover in it is
+    # overwritten, so this goes by the covers: how many there are, their total size and the latest mtime
+    if base_dir.endswith(".atlas"):
+        return stamp(base_dir)
+
+    count, size, mtime = 0, 0, 0
+    for entry in os.scandir(base_dir):
+        if entry.name.endswith(".png"):
+            entry_stat = entry.stat()
+            count += 1
+            size += entry_stat.st_size
+            mtime = max(mtime, entry_stat.st_mtime_ns)
+    return count, size, mtime
+
+
+# Raised for requests naming something that doesn't exist, which the server answers with a 404
+class NotFound(Exception):
+    pass
+
+
+# Raised for requests with missing or malformed parameters, which the server answers with a 400
+class BadRequest(Exception):
+    pass
+
+
+def parameter(query, name: str, kind, default=None):
+    # query[name] converted with kind. Required if there is no default
+    if name not in query:
+        if default is None:
+            raise BadRequest(f"Missing parameter {name}")
+        return default
+    try:
+        return kind(query[name])
+    except ValueError:
+        raise BadRequest(f"Bad value for {name}: {query[name]!r}")
+
+
+def render_job(job):
+    # For the render pool: a full render with image.render_poster, returning the files written
+    placement, settings, base_dir, canvas_width, canvas_height, options = job
+    stats.reset()
+    files = image.render_poster(placement, settings, base_dir, canvas_width, canvas_height, **options)
+    return files, stats.to_dict()
+
+
+class PosterService:
+
+    def __init__(self, base_dir="artwork", tracks_file=history.TRACKS_FILE, canvas_width=14043, canvas_height=9933,
+                 placement_file: str = None, seed=0, engine_name="random", max_tile_bytes=512 * 1024 * 1024,
+                 render_processes=1):
+        self.base_dir = base_dir  # Artwork directory, or an atlas file ending .atlas
+        self.tracks_file = tracks_file
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.placement_file = placement_file  # Placement to serve, with its .settings. Allocated if None
+        self.seed = seed
+        self.engine_name = engine_name
+        self.max_tile_bytes = max_tile_bytes
+
+        # Requests are handled on threads, everything below is guarded by lock
+        self.lock = threading.RLock()
+        self.stamps = {}
+        self.store = None
+        self.artwork = None  # base_dir, or the opened Atlas
+        self.settings = None
+        self.placement = None
+        self.tiles = OrderedDict()  # (aid, px) -> resized cover, least recently used first
+        self.tile_bytes = 0
+
+        self.render_pool = concurrent.futures.ProcessPoolExecutor(render_processes)
+        self.jobs = {}  # Job id -> Future
+
+    def _input_stamps(self):
+        stamps = {"history": stamp(self.tracks_file), "artwork": artwork_stamp(self.base_dir)}
+        if self.placement_file is not None:
+            stamps["placement"] = stamp(self.placement_file)
+        return stamps
+
+    # Reloads whatever changed since the last request
+    def refresh(self):
+        with self.lock:
+            stamps = self._input_stamps()
+            changed = {name for name in stamps if stamps[name] != self.stamps.get(name)}
+            if len(changed) == 0:
+                return
+
+            if "history" in changed:
+                stats.log(PROGRESS, "Loading history")
+                self.store = history.HistoryStore.load(self.tracks_file)
+            if "artwork" in changed:
+                self.close_artwork()
+                self.artwork = Atlas(self.base_dir) if self.base_dir.endswith(".atlas") else self.base_dir
+                self.clear_tiles()
+
+            files = image.get_files(self.artwork)
+            if self.placement_file is not None:
+                self.settings = load_settings(f"{self.placement_file}.settings")
+                self.placement = image.Placement(0, 0)
+                self.placement.load(self.placement_file)
+            else:
+                freq = self.store.album_counts()
+                posters, sizes = image.group_posters(files, freq, image.get_brackets(freq))
+                self.settings = compute_settings(len(files), self.canvas_width, self.canvas_height, sizes)
+                random.seed(self.seed)
+                self.placement = image.do_allocation(self.settings, posters,
+                                                     engine=image.ENGINES[self.engine_name]())
+            self.placement.drop_indexes()
+            self.stamps = stamps
+
+    def invalidate(self):
+        # Everything is reloaded on the next request
+        with self.lock:
+            self.stamps = {}
+            self.clear_tiles()
+
+    def clear_tiles(self):
+        with self.lock:
+            self.tiles = OrderedDict()
+            self.tile_bytes = 0
+
+    def tile(self, aid: str, size: int, settings) -> Image:
+        key = (aid, settings.dim * size)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                stats.count("service tile hits")
+                return self.tiles[key]
+
+        stats.count("service tile misses")
+        tile = image.read_artwork(self.artwork, aid, size, settings, reduced=True).convert("RGB")
+        with self.lock:
+            self.tiles[key] = tile
+            self.tile_bytes += tile.width * tile.height * 3
+            while self.tile_bytes > self.max_tile_bytes:
+                _, old = self.tiles.popitem(last=False)
+                self.tile_bytes -= old.width * old.height * 3
+        return tile
+
+    def _scaled_settings(self, scale):
+        settings = copy.copy(self.settings)
+        settings.dim = max(1, round(self.settings.dim * scale))
+        return settings
+
+    # The part of the poster (without the safety margin) from x, y to x + width, y + height, in full size
+    # pixels, drawn at scale
+    def region(self, x, y, width, height, scale=1.0) -> Image:
+        self.refresh()
+        with self.lock:
+            settings = self._scaled_settings(scale)
+            placement = self.placement
+            left = round(int(self.settings.right_margin_px / 2) * scale)
+            top = round(int(self.settings.bottom_margin_px / 2) * scale)
+
+        x0, y0 = round(x * scale), round(y * scale)
+        out = Image.new("RGB", (max(1, round(width * scale)), max(1, round(height * scale))), "white")
+        for aid, (x_row, y_row) in placement.placements.items():
+            size = placement.placement_size[aid]
+            px = settings.dim * size
+            tile_x = left + x_row * settings.dim - x0
+            tile_y = top + y_row * settings.dim - y0
+            if tile_x < out.width and tile_y < out.height and tile_x + px > 0 and tile_y + px > 0:
+                out.paste(self.tile(aid, size, settings), (tile_x, tile_y))
+        return out
+
+    def preview(self, width=1400) -> Image:
+        return self.region(0, 0, self.canvas_width, self.canvas_height, width / self.canvas_width)
+
+    def start_render(self, options) -> int:
+        self.refresh()
+        with self.lock:
+            job = (self.placement, self.settings, self.artwork, self.canvas_width, self.canvas_height, options)
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = self.render_pool.submit(render_job, job)
+        return job_id
+
+    def job_status(self, job_id: int):
+        if job_id not in self.jobs:
+            raise NotFound(f"No job {job_id}")
+        future = self.jobs[job_id]
+        if not future.done():
+            return {"id": job_id, "state": "running"}
+        if future.exception() is not None:
+            return {"id": job_id, "state": "failed", "error": repr(future.exception())}
+        files, job_stats = future.result()
+        return {"id": job_id, "state": "done", "files": files, "stats": job_stats}
+
+    def status(self):
+        self.refresh()
+        with self.lock:
+            return {
+                "albums": len(self.placement.placements),
+                "grid": [self.placement.n_x, self.placement.n_y],
+                "dim": self.settings.dim,
+                "cached_tiles": len(self.tiles),
+                "cached_tile_bytes": self.tile_bytes,
+                "jobs": {job_id: "done" if future.done() else "running" for job_id, future in self.jobs.items()},
+                "stats": stats.to_dict(),
+            }
+
+    def close_artwork(self):
+        with self.lock:
+            if isinstance(self.artwork, Atlas):
+                self.artwork.close()
+            self.artwork = None
+
+    def close(self):
+        self.render_pool.shutdown()
+        self.close_artwork()
+
+
+def png_bytes(picture: Image) -> bytes:
+    out = io.BytesIO()
+    picture.save(out, "PNG", compress_level=1)
+    return out.getvalue()
+
+
+# Minimal HTTP/1.0 over asyncio: one request per connection, answered then closed. Drawing runs on the
+# default thread pool so one slow request doesn't hold up the rest
+class ServiceServer:
+
+    def __init__(self, service: PosterService):
+        self.service = service
+
+    def route(self, method: str, path: str, body: bytes):
+        url = urllib.parse.urlparse(path)
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        if method == "GET" and url.path == "/preview":
+            return "image/png", png_bytes(self.service.preview(parameter(query, "width", int, 1400)))
+        if method == "GET" and url.path == "/crop":
+            x, y = parameter(query, "x", int), parameter(query, "y", int)
+            width, height = parameter(query, "w", int), parameter(query, "h", int)
+            picture = self.service.region(x, y, width, height, parameter(query, "scale", float, 1.0))
+            return "image/png", png_bytes(picture)
+        if method == "GET" and url.path == "/status":
+            return "application/json", json.dumps(self.service.status()).encode("utf-8")
+        if method == "GET" and url.path.startswith("/jobs/"):
+            status = self.service.job_status(parameter({"id": url.path[len("/jobs/"):]}, "id", int))
+            return "application/json", json.dumps(status).encode("utf-8")
+        if method == "POST" and url.path == "/render":
+            try:
+                options = json.loads(body) if len(body) > 0 else {}
+            except ValueError:
+                raise BadRequest("Render options aren't JSON")
+            return "application/json", json.dumps({"id": self.service.start_render(options)}).encode("utf-8")
+        if method == "POST" and url.path == "/invalidate":
+            self.service.invalidate()
+            return "application/json", b"{}"
+        raise NotFound(f"{method} {url.path}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            method, path, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            try:
+                content_type, content = await asyncio.get_running_loop().run_in_executor(
+                    None, self.route, method, path, body)
+                status = "200 OK"
+            except NotFound as e:
+                status, content_type, content = "404 Not Found", "text/plain", str(e).encode("utf-8")
+            except BadRequest as e:
+                status, content_type, content = "400 Bad Request", "text/plain", str(e).encode("utf-8")
+            except Exception as e:
+                status, content_type, content = "500 Internal Server Error", "text/plain", repr(e).encode("utf-8")
+
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(content)}\r\n\r\n".encode("latin-1") + content)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        stats.log(PROGRESS, f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+class ServiceClient:
+
+    def __init__(self, host="127.0.0.1", port=PORT, timeout=600):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, body: bytes = b""):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            content = response.read()
+            if response.status != 200:
+                raise RuntimeError(f"{method} {path}: {response.status} {content.decode('utf-8', 'replace')}")
+            return content
+        finally:
+            connection.close()
+
+    def get(self, path: str):
+        return self.request("GET", path)
+
+    def post(self, path: str, options=None):
+        return json.loads(self.request("POST", path, json.dumps(options or {}).encode("utf-8")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poster render service and its client")
+    parser.add_argument("command", choices=["serve", "get", "post"])
+    parser.add_argument("path", nargs="?", help="Request path for get and post")
+    parser.add_argument("data", nargs="?", help="Output file for get, JSON options for post")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--artwork", default="artwork", help="Artwork directory or .atlas file")
+    parser.add_argument("--placement", help="Placement file to serve instead of allocating one")
+    parser.add_argument("--width", type=int, default=14043)
+    parser.add_argument("--height", type=int, default=9933)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        service = PosterService(args.artwork, canvas_width=args.width, canvas_height=args.height,
+                                placement_file=args.placement)
+        try:
+            asyncio.run(ServiceServer(service).serve(port=args.port))
+        finally:
+            service.close()
+        return
+
+    client = ServiceClient(port=args.port)
+    if args.command == "post":
+        print(json.dumps(client.post(args.path, json.loads(args.data) if args.data else None), indent=2))
+        return
+
+    content = client.get(args.path)
+    if args.data is None:
+        sys.stdout.write(content.decode("utf-8"))
+    else:
+        with open(args.data, "wb") as f:
+            f.write(content)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+from PIL import Image
+import multiprocessing
+import os
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+# Writes an 8-bit RGB PNG a strip of rows at a time, so the full image never has to be in memory.
+# Rows are stored unfiltered - the file is a bit larger than PIL's output but any viewer can read it
+class StreamingPNGWriter:
+
+    def __init__(self, file: str, width: int, height: int, compress_level=6):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.out = open(file, "wb")
+        self.out.write(PNG_SIGNATURE)
+        # Bit depth 8, colour type 2 (RGB), default compression, filtering and no interlace
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.out.close()
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes):
+        self.out.write(struct.pack(">I", len(data)))
+        self.out.write(chunk_type)
+        self.out.write(data)
+        self.out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_strip(self, strip: Image):
+        assert strip.mode == "RGB" and strip.width == self.width
+        assert self.rows_written + strip.height <= self.height
+
+        raw = strip.tobytes()
+        stride = self.width * 3
+        rows = []
+        for row in range(strip.height):
+            rows.append(b"\x00")  # Filter type: none
+            rows.append(raw[row * stride:(row + 1) * stride])
+
+        compressed = self.compressor.compress(b"".join(rows))
+        if len(compressed) > 0:
+            self._write_chunk(b"IDAT", compressed)
+
+        self.rows_written += strip.height
+
+    def close(self):
+        assert self.rows_written == self.height
+        self._write_chunk(b"IDAT", self.compressor.flush())
+        self._write_chunk(b"IEND", b"")
+        self.out.close()
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    # Adler-32 of two pieces of data from the checksum of each, as zlib's adler32_combine
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - remainder) % base
+    return sum1 | (sum2 << 16)
+
+
+def deflate_strip(job):
+    # Filters and compresses one strip on its own, ending on a byte boundary so the pieces can be concatenated
+    raw, width, compress_level = job
+    stride = width * 3
+    filtered = b"".join(b"\x00" + raw[row:row + stride] for row in range(0, len(raw), stride))
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(filtered) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(filtered), len(filtered)
+
+
+# StreamingPNGWriter that compresses strips in parallel on a pool of processes. Each strip is deflated on its
+# own (so a little larger than one stream) and the pieces are joined into one valid zlib stream, with its
+# checksum combined from the strips'. Strips are written in order and at most a few are held at once
+class ParallelPNGWriter(StreamingPNGWriter):
+
+    def __init__(self, file: str, width: int, height: int, compress_level=6, processes=None):
+        super().__init__(file, width, height, compress_level)
+        self.compress_level = compress_level
+        self.pool = multiprocessing.Pool(processes)
+        self.in_flight = []
+        self.max_in_flight = 2 * (processes or os.cpu_count())
+        self.adler = 1
+        # zlib header: deflate with a 32K window, no preset dictionary
+        self.pending_header = b"\x78\x9c"
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.pool.terminate()
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+    def write_strip(self, strip: Image):
+        assert strip.mode == "RGB" and strip.width == self.width
+        assert self.rows_written + strip.height <= self.height
+
+        job = (strip.tobytes(), self.width, self.compress_level)
+        self.in_flight.append(self.pool.apply_async(deflate_strip, (job,)))
+        while len(self.in_flight) > self.max_in_flight:
+            self._write_next()
+        self.rows_written += strip.height
+
+    def _write_next(self):
+        compressed, adler, length = self.in_flight.pop(0).get()
+        self.adler = adler32_combine(self.adler, adler, length)
+        self._write_chunk(b"IDAT", self.pending_header + compressed)
+        self.pending_header = b""
+
+    def close(self):
+        assert self.rows_written == self.height
+        while len(self.in_flight) > 0:
+            self._write_next()
+        self.pool.close()
+        self.pool.join()
+
+        # An empty final block, then the checksum of everything compressed
+        self._write_chunk(b"IDAT", self.pending_header + b"\x03\x00" + struct.pack(">I", self.adler))
+        self._write_chunk(b"IEND", b"")
+        self.out.close()
+
+
+def png_writer(file: str, width: int, height: int, compress_level=6, processes=1) -> StreamingPNGWriter:
+    # processes=None uses every core
+    if processes == 1:
+        return StreamingPNGWriter(file, width, height, compress_level)
+    return ParallelPNGWriter(file, width, height, compress_level, processes)
@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+import image
+from compute import Settings
+
+
+def grid_settings(n_x, n_y):
+    return Settings(n_x, n_y, 10, 0)
+
+
+def covers(prefix, count):
+    return [f"{prefix}{i}.png" for i in range(count)]
+
+
+def check_placement(placement, posters):
+    # Every square above size 1 is placed at its size and every album owns exactly the cells of its square
+    for size_index, posters_for_size in enumerate(posters[1:]):
+        for poster in posters_for_size:
+            assert placement.placement_size[image.poster_id(poster)] == size_index + 2
+
+    owned = {}
+    for x in range(placement.n_x):
+        for y in range(placement.n_y):
+            aid = placement.owner(x, y)
+            if aid is not None:
+                owned.setdefault(aid, set()).add((x, y))
+    assert owned == {aid: set(placement.cells(aid)) for aid in placement.placements}
+
+
+def test_do_allocation_places_every_large_square():
+    random.seed(0)
+    posters = [covers("a", 40), covers("b", 6), [], covers("d", 1)]
+    check_placement(image.do_allocation(grid_settings(12, 10), posters), posters)
+
+
+# Placements the original random engine drew for these seeds, so a seeded run still draws the same poster
+SEEDED_PLACEMENTS = {
+    0: {
+        "d0": (8, 1, 4), "c0": (9, 6, 3), "c1": (1, 1, 3), "c2": (3, 8, 3), "b0": (6, 8, 2), "b1": (6, 1, 2),
+        "b2": (13, 3, 2), "b3": (2, 5, 2), "b4": (11, 9, 2), "b5": (6, 4, 2), "b6": (13, 6, 2), "b7": (1, 9, 2),
+        "b8": (4, 4, 2), "b9": (13, 1, 2)
+    },
+    3: {
+        "d0": (5, 3, 4), "c0": (10, 2, 3), "c1": (2, 7, 3), "c2": (8, 8, 3), "b0": (12, 8, 2), "b1": (3, 3, 2),
+        "b2": (10, 5, 2), "b3": (8, 1, 2), "b4": (13, 4, 2), "b5": (6, 7, 2), "b6": (13, 1, 2), "b7": (1, 3, 2),
+        "b8": (5, 9, 2), "b9": (3, 5, 2)
+    },
+}
+
+
+@pytest.mark.parametrize("seed", sorted(SEEDED_PLACEMENTS))
+def test_do_allocation_keeps_the_placement_of_a_seed(seed):
+    random.seed(seed)
+    posters = [covers("a", 100), covers("b", 10), covers("c", 3), covers("d", 1)]
+    placement = image.do_allocation(grid_settings(16, 12), posters)
+    large = {aid: (*placement.placements[aid], size) for aid, size in placement.placement_size.items() if size > 1}
+    assert large == SEEDED_PLACEMENTS[seed]
+
+
+def test_do_allocation_raises_when_squares_do_not_fit():
+    posters = [[], [], [], covers("d", 4)]
+    with pytest.raises(image.AllocationFailed):
+        image.do_allocation(grid_settings(6, 6), posters)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_update_allocation_places_displaced_squares_again(seed):
+    # A new size 4 square on a full grid has to displace size 2 squares, which then displace size 1 covers
+    random.seed(seed)
+    settings = grid_settings(14, 12)
+    ones = covers("a", 108)
+    twos = covers("b", 15)
+    placement = image.do_allocation(settings, [ones, twos])
+    before = {(x, y): placement.owner(x, y) for x in range(14) for y in range(12)}
+
+    posters = [ones[:50], twos, [], covers("d", 1)]
+    dirty = image.update_allocation(placement, settings, posters)
+
+    check_placement(placement, posters)
+    for poster in posters[0]:
+        assert placement.placement_size[image.poster_id(poster)] == 1
+    changed = {cell for cell, aid in before.items() if placement.owner(*cell) != aid}
+    assert changed <= dirty
+
+
+def test_multi_start_runs_of_a_lattice_engine_differ():
+    posters = [covers("a", 60), covers("b", 8), [], covers("d", 2)]
+    engine = image.LatticeEngine(jitter=0.5)
+    runs = [image.allocation_run((grid_settings(14, 12), posters, seed, engine))[1] for seed in range(2)]
+    assert runs[0].placements != runs[1].placements
+
+    with pytest.raises(ValueError):
+        image.do_allocation_multi_start(grid_settings(14, 12), posters, runs=2, engine=image.LatticeEngine())
+
+
+def test_blocked_cells_have_no_owner():
+    placement = image.Placement(4, 4)
+    placement.alloc(0, 0, image.BLOCKED)
+    placement.place_square("a", 1, 1, 2)
+
+    assert not placement.is_free(0, 0)
+    assert placement.owner(0, 0) is None
+    assert placement.owner(1, 1) == "a"
+    assert placement.region_owners(0, 0, 4, 4) == ["a"]
+    assert set(placement.cells("a")) == {(1, 1), (1, 2), (2, 1), (2, 2)}
+
+
+def test_do_allocation_regions_places_every_large_square():
+    # Fills all but the end of the bottom row, which large squares can't reach
+    posters = [covers("a", 342), covers("b", 20), [], covers("d", 3)]
+    placement = image.do_allocation_regions(grid_settings(24, 20), posters, 2, 2, processes=1)
+    check_placement(placement, posters)
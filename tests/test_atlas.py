@@ -0,0 +1,76 @@
+import os
+
+from PIL import Image
+
+import atlas
+
+
+def write_cover(base_dir, aid, colour, mtime_ns):
+    file = os.path.join(base_dir, f"{aid}.png")
+    Image.new("RGB", (50, 50), colour).save(file)
+    os.utime(file, ns=(mtime_ns, mtime_ns))
+
+
+def read_tiles(file):
+    packed = atlas.Atlas(file)
+    tiles = {aid: packed.level(aid, 0).convert("RGB").getpixel((0, 0)) for aid in packed.tiles}
+    means = {aid: packed.mean_colour(aid) for aid in packed.tiles}
+    packed.close()
+    return tiles, means
+
+
+def test_build_atlas_decodes_only_new_and_changed_covers(tmp_path):
+    base_dir = str(tmp_path / "artwork")
+    file = str(tmp_path / "artwork.atlas")
+    os.makedirs(base_dir)
+    write_cover(base_dir, "a", (255, 0, 0), 10 ** 18)
+    write_cover(base_dir, "b", (0, 255, 0), 10 ** 18)
+    write_cover(base_dir, "c", (0, 0, 255), 10 ** 18)
+
+    assert atlas.build_atlas(base_dir, file, tile_px=32, num_levels=3) == 3
+    assert read_tiles(file)[0] == {"a": (255, 0, 0), "b": (0, 255, 0), "c": (0, 0, 255)}
+
+    # Nothing changed, so the atlas isn't rewritten
+    built = os.stat(file).st_mtime_ns
+    assert atlas.build_atlas(base_dir, file, tile_px=32, num_levels=3) == 0
+    assert os.stat(file).st_mtime_ns == built
+
+    write_cover(base_dir, "b", (255, 255, 0), 2 * 10 ** 18)
+    write_cover(base_dir, "d", (255, 255, 255), 10 ** 18)
+    os.remove(os.path.join(base_dir, "c.png"))
+    assert atlas.build_atlas(base_dir, file, tile_px=32, num_levels=3) == 2
+
+    tiles, means = read_tiles(file)
+    assert tiles == {"a": (255, 0, 0), "b": (255, 255, 0), "d": (255, 255, 255)}
+    assert means == tiles
+
+
+def test_build_atlas_rebuilds_for_a_different_tile_size(tmp_path):
+    base_dir = str(tmp_path / "artwork")
+    file = str(tmp_path / "artwork.atlas")
+    os.makedirs(base_dir)
+    write_cover(base_dir, "a", (255, 0, 0), 10 ** 18)
+
+    assert atlas.build_atlas(base_dir, file, tile_px=32, num_levels=3) == 1
+    assert atlas.build_atlas(base_dir, file, tile_px=16, num_levels=2) == 1
+    packed = atlas.Atlas(file)
+    assert (packed.tile_px, packed.num_levels) == (16, 2)
+    packed.close()
+
+
+def test_artwork_outlives_the_atlas(tmp_path):
+    base_dir = str(tmp_path / "artwork")
+    os.makedirs(base_dir)
+    write_cover(base_dir, "a", (10, 20, 30), 10 ** 18)
+    file = str(tmp_path / "artwork.atlas")
+    atlas.build_atlas(base_dir, file, tile_px=32, num_levels=3)
+
+    packed = atlas.Atlas(file)
+    exact = packed.artwork("a", 16)
+    resized = packed.artwork("a", 12)
+    view = packed.level("a", 0)
+    packed.close()
+
+    assert exact.size == (16, 16) and resized.size == (12, 12)
+    assert exact.convert("RGB").getpixel((0, 0)) == resized.convert("RGB").getpixel((0, 0)) == (10, 20, 30)
+    del view
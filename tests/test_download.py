@@ -0,0 +1,119 @@
+import http.server
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+import download
+
+
+class CoverHandler(http.server.BaseHTTPRequestHandler):
+    # Serves b"cover <name>" for /<name>, after failing the first failures[name] requests for it with a 500
+
+    def do_GET(self):
+        name = self.path.lstrip("/")
+        with self.server.lock:
+            self.server.requests.append(name)
+            failing = self.server.failures.get(name, 0) > 0
+            if failing:
+                self.server.failures[name] -= 1
+
+        if failing or name == "missing":
+            self.send_error(500 if failing else 404)
+            return
+
+        body = f"cover {name}".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CoverHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def url(server, name):
+    return f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+
+def read(file):
+    with open(file, "rb") as f:
+        return f.read()
+
+
+def test_fetch_retries_until_the_server_answers(server, tmp_path):
+    server.failures["a"] = 2
+    dest = str(tmp_path / "a.png")
+    assert download.fetch(download.make_session(1), url(server, "a"), dest, retries=3, backoff=0)
+    assert read(dest) == b"cover a"
+    assert server.requests == ["a", "a", "a"]
+    assert not os.path.exists(f"{dest}.part")
+
+
+def test_fetch_gives_up_without_leaving_a_file(server, tmp_path):
+    dest = str(tmp_path / "missing.png")
+    assert not download.fetch(download.make_session(1), url(server, "missing"), dest, retries=1, backoff=0)
+    assert server.requests == ["missing", "missing"]
+    assert not os.path.exists(dest)
+    assert not os.path.exists(f"{dest}.part")
+
+
+def test_download_all_fetches_each_url_once_and_skips_finished_ids(server, tmp_path):
+    out_dir = str(tmp_path / "artwork")
+    os.makedirs(out_dir)
+    # Left behind by an interrupted run: neither is in the manifest, so both are fetched again
+    with open(os.path.join(out_dir, "b.png"), "wb") as f:
+        f.write(b"cov")
+    with open(os.path.join(out_dir, "c.png.part"), "wb") as f:
+        f.write(b"co")
+
+    items = [("a", url(server, "x")), ("b", url(server, "y")), ("c", url(server, "z")), ("d", url(server, "x")),
+             ("e", url(server, "missing"))]
+    failed = download.download_all(items, out_dir, workers=4, retries=0, backoff=0)
+
+    assert failed == ["e"]
+    assert sorted(server.requests) == ["missing", "x", "y", "z"]
+    assert [read(os.path.join(out_dir, f"{id}.png")) for id in "abcd"] == [b"cover x", b"cover y", b"cover z",
+                                                                         b"cover x"]
+    assert sorted(os.listdir(out_dir)) == [download.MANIFEST_FILE, "a.png", "b.png", "c.png", "d.png"]
+
+    manifest = download.Manifest(out_dir)
+    assert all(id in manifest for id in "abcd") and "e" not in manifest
+
+    # A rerun only asks for what failed
+    server.requests.clear()
+    assert download.download_all(items, out_dir, workers=4, retries=0, backoff=0) == ["e"]
+    assert server.requests == ["missing"]
+
+
+def test_download_all_keeps_covers_downloaded_before_the_manifest(server, tmp_path):
+    out_dir = str(tmp_path / "artwork")
+    os.makedirs(out_dir)
+    Image.new("RGB", (8, 8), "red").save(os.path.join(out_dir, "a.png"), "JPEG")
+    Image.new("RGB", (8, 8), "red").save(os.path.join(out_dir, "b.png"))
+    with open(os.path.join(out_dir, "b.png"), "r+b") as f:
+        f.truncate(40)
+    Image.new("RGB", (8, 8), "red").save(os.path.join(out_dir, "c.png.part"), "PNG")
+
+    items = [("a", url(server, "x")), ("b", url(server, "y")), ("c", url(server, "z"))]
+    assert download.download_all(items, out_dir, workers=2, retries=0, backoff=0) == []
+    assert sorted(server.requests) == ["y", "z"]
+    assert read(os.path.join(out_dir, "b.png")) == b"cover y"
+    assert all(id in download.Manifest(out_dir) for id in "abc")
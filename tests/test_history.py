@@ -0,0 +1,53 @@
+import datetime
+import json
+
+import history
+from instrument import stats
+
+
+def write_tracks(file, plays):
+    with open(file, "w") as f:
+        for played_at, album in plays:
+            f.write(json.dumps({
+                "played_at": {"$date": played_at},
+                "track": {
+                    "id": f"{album}-track",
+                    "name": "Track",
+                    "artists": [{"id": "artist", "name": "Artist"}],
+                    "album": {"id": album, "name": f"Album {album}"},
+                },
+            }) + "\n")
+
+
+def utc(year):
+    return datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def test_history_store_is_read_back_from_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(history.HistoryStore, "BLOCK", 2)
+    tracks_file = str(tmp_path / "tracks.json")
+    write_tracks(tracks_file, [("2017-03-01T10:00:00.000Z", "a"), ("2018-03-01T10:00:00.000Z", "b"),
+                               ("2016-03-01T10:00:00.000Z", "a"), ("2018-05-01T10:00:00.000Z", "a"),
+                               ("2018-06-01T10:00:00.000Z", "c")])
+
+    stats.reset()
+    built = history.HistoryStore.load(tracks_file)
+    read = history.HistoryStore.load(tracks_file)
+    assert stats.counters["history store misses"] == 1
+    assert stats.counters["history store hits"] == 1
+    assert not (tmp_path / "tracks.json.cache").exists()
+
+    for name in ["times", "albums", "artists", "tracks", "checkpoints", "album_ids", "album_names"]:
+        assert getattr(read, name) == getattr(built, name)
+    assert read.album_counts() == {"a": 3, "b": 1, "c": 1}
+    assert read.album_counts(utc(2017), utc(2019)) == {"a": 2, "b": 1, "c": 1}
+    assert read.album_counts(utc(2018), utc(2019)) == built.album_counts(utc(2018), utc(2019))
+
+
+def test_history_store_is_rebuilt_when_the_history_changes(tmp_path):
+    tracks_file = str(tmp_path / "tracks.json")
+    write_tracks(tracks_file, [("2017-03-01T10:00:00.000Z", "a")])
+    assert history.HistoryStore.load(tracks_file).album_counts() == {"a": 1}
+
+    write_tracks(tracks_file, [("2017-03-01T10:00:00.000Z", "a"), ("2017-04-01T10:00:00.000Z", "b")])
+    assert history.HistoryStore.load(tracks_file).album_counts() == {"a": 1, "b": 1}
@@ -0,0 +1,89 @@
+import os
+import random
+
+import pytest
+
+import image
+import placement_file
+from compute import Settings
+
+
+def covers(prefix, count):
+    return [f"{prefix}{i}.png" for i in range(count)]
+
+
+def squares(placement):
+    return {aid: (*placement.placements[aid], placement.placement_size[aid]) for aid in placement.placements}
+
+
+@pytest.fixture
+def placement():
+    random.seed(0)
+    return image.do_allocation(Settings(12, 10, 10, 0), [covers("a", 40), covers("b", 6), [], covers("d", 1)])
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_placement_round_trip(tmp_path, placement, binary):
+    file = str(tmp_path / "placement")
+    if binary:
+        placement.save_binary(file)
+    else:
+        placement.save(file)
+    assert placement_file.is_placement_file(file) == binary
+
+    loaded = image.Placement(0, 0)
+    loaded.load(file)
+    assert (loaded.n_x, loaded.n_y) == (placement.n_x, placement.n_y)
+    assert squares(loaded) == squares(placement)
+
+
+def test_read_journal_drops_a_torn_record(tmp_path):
+    file = str(tmp_path / "journal")
+    journal = placement_file.PlacementJournal(file, 12, 10, b"k" * 20)
+    journal.write("a", 1, 2, 2)
+    journal.write("b", 3, 4, 1)
+    journal.close()
+    whole = os.path.getsize(file)
+    with open(file, "ab") as f:
+        f.write(placement_file.JOURNAL_RECORD.pack(5, 6, 1, 3) + b"c")
+
+    assert placement_file.read_journal(file) == (12, 10, b"k" * 20, [("a", 1, 2, 2), ("b", 3, 4, 1)])
+    assert os.path.getsize(file) == whole
+
+
+def test_do_allocation_resumes_a_journal_of_the_same_allocation(tmp_path):
+    settings = Settings(12, 10, 10, 0)
+    posters = [covers("a", 40), covers("b", 6), [], covers("d", 1)]
+    file = str(tmp_path / "journal")
+    journal = placement_file.PlacementJournal(file, 12, 10, image.journal_key(settings, posters))
+    journal.write("d0", 1, 1, 4)
+    journal.close()
+
+    random.seed(0)
+    placement = image.do_allocation(settings, posters, file)
+    assert squares(placement)["d0"] == (1, 1, 4)
+    assert placement.journal is None
+
+
+def test_do_allocation_discards_a_journal_of_other_posters(tmp_path):
+    settings = Settings(12, 10, 10, 0)
+    file = str(tmp_path / "journal")
+    random.seed(0)
+    image.do_allocation(settings, [covers("a", 40), covers("b", 6), [], covers("d", 1)], file)
+
+    posters = [covers("a", 40), covers("b", 5), [], covers("e", 1)]
+    random.seed(0)
+    placement = image.do_allocation(settings, posters, file)
+    assert "d0" not in placement.placements and "b5" not in placement.placements
+    assert placement.placement_size["e0"] == 4
+
+
+def test_do_allocation_deletes_the_journal_at_a_dead_end(tmp_path):
+    settings = Settings(6, 6, 10, 0)
+    posters = [[], covers("b", 2), [], covers("d", 4)]
+    file = str(tmp_path / "journal")
+    for seed in range(3):
+        random.seed(seed)
+        with pytest.raises(image.AllocationFailed):
+            image.do_allocation(settings, posters, file)
+        assert not os.path.exists(file)
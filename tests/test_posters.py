@@ -0,0 +1,18 @@
+import image
+
+
+def test_played_files_keeps_only_albums_in_the_range():
+    files = ["a.png", "b.png", "c.png", "d.png"]
+    freq = {"a": 5, "c": 1}
+    assert image.played_files(files, freq) == ["a.png", "c.png"]
+
+
+def test_group_posters_sizes_by_bracket():
+    freq = {f"a{i}": i + 1 for i in range(200)}
+    files = [f"a{i}.png" for i in range(200)]
+    posters, sizes = image.group_posters(files, freq, image.get_brackets(freq))
+
+    assert len(posters) == 4 and posters[2] == []
+    assert sizes == [(1, len(posters[0])), (2, len(posters[1])), (4, len(posters[3]))]
+    assert sum(len(p) for p in posters) == 200
+    assert "a199.png" in posters[3] and "a0.png" in posters[0]
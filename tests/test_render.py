@@ -0,0 +1,70 @@
+import random
+
+import pytest
+from PIL import Image, ImageChops
+
+import bench
+import image
+from compute import compute_settings
+
+
+@pytest.fixture
+def poster(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    freq = bench.make_frequencies(150)
+    bench.make_artwork("artwork", freq.keys(), px=32, kind="solid")
+    files = image.get_files("artwork")
+    posters, sizes = image.group_posters(files, freq, image.get_brackets(freq))
+    settings = compute_settings(len(files), 400, 300, sizes)
+    random.seed(0)
+    return image.do_allocation(settings, posters), settings
+
+
+@pytest.mark.parametrize("render_mode", ["serial", "stream"])
+def test_render_poster_writes_the_safe_copy_only_with_a_margin(poster, render_mode):
+    placement, settings = poster
+    files = image.render_poster(placement, settings, "artwork", 400, 300, render_mode, safety_px=0)
+    assert files == ["out.png"]
+    assert Image.open("out.png").size == (400, 300)
+
+    files = image.render_poster(placement, settings, "artwork", 400, 300, render_mode, safety_px=10)
+    assert files == (["out.png", "out-safe.png"] if render_mode == "serial" else ["out-safe.png"])
+    assert Image.open("out-safe.png").size == (420, 320)
+
+
+def test_pipelined_render_matches_serial_for_large_jpeg_covers(poster):
+    # Like the downloader saves them: 640 px JPEGs named .png
+    placement, settings = poster
+    noise = Image.effect_noise((640, 640), 60).convert("RGB")
+    for i, aid in enumerate(placement.placements):
+        ImageChops.offset(noise, i * 37, i * 11).save(f"artwork/{aid}.png", "JPEG")
+
+    serial = image.PosterImage(400, 300, 0, 0)
+    image.render_serial(placement, settings, "artwork", serial)
+    pipelined = image.PosterImage(400, 300, 0, 0)
+    image.render_pipelined(placement, settings, "artwork", pipelined)
+    assert pipelined.base.tobytes() == serial.base.tobytes()
+
+
+def test_render_modes_draw_the_same_poster(poster):
+    placement, settings = poster
+    bench.make_artwork("artwork", placement.placements, px=64)
+    left_margin = int(settings.right_margin_px / 2)
+    top_margin = int(settings.bottom_margin_px / 2)
+
+    serial = image.PosterImage(400, 300, left_margin, top_margin)
+    image.render_serial(placement, settings, "artwork", serial)
+    expected = serial.base.tobytes()
+
+    parallel = image.PosterImage(400, 300, left_margin, top_margin)
+    image.render_parallel(placement, settings, "artwork", parallel, num_bands=7, processes=2)
+    assert parallel.base.tobytes() == expected
+
+    canvas = image.ArrayCanvas(400, 300, left_margin, top_margin, batch_size=5)
+    image.render_serial(placement, settings, "artwork", canvas)
+    assert canvas.to_image().tobytes() == expected
+
+    image.stream_poster(placement, settings, "artwork", 400, 300, left_margin, top_margin, "streamed.png",
+                        safety_px=9, strip_height=50)
+    with Image.open("streamed.png") as streamed:
+        assert streamed.tobytes() == image.add_safety_margin(serial.base, 400, 300, 9).tobytes()
@@ -0,0 +1,111 @@
+import asyncio
+import io
+import json
+import os
+import socket
+import threading
+
+import pytest
+from PIL import Image
+
+import bench
+import service
+
+
+async def stop_serving():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def served(tmp_path):
+    freq = bench.make_frequencies(120)
+    tracks_file = str(tmp_path / "tracks.json")
+    bench.make_history(tracks_file, freq)
+    base_dir = str(tmp_path / "artwork")
+    bench.make_artwork(base_dir, freq.keys(), kind="solid")
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    poster_service = service.PosterService(base_dir, tracks_file, canvas_width=700, canvas_height=500)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(service.ServiceServer(poster_service).serve(port=port), loop)
+    client = service.ServiceClient(port=port, timeout=30)
+    try:
+        for _ in range(100):
+            try:
+                client.get("/status")
+                break
+            except ConnectionRefusedError:
+                threading.Event().wait(0.05)
+        yield client, poster_service, base_dir
+    finally:
+        asyncio.run_coroutine_threadsafe(stop_serving(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        poster_service.close()
+
+
+def png(content: bytes) -> Image:
+    return Image.open(io.BytesIO(content)).convert("RGB")
+
+
+def test_status_and_preview(served):
+    client, poster_service, _ = served
+    status = json.loads(client.get("/status"))
+    assert status["albums"] == len(poster_service.placement.placements) > 0
+
+    preview = png(client.get("/preview?width=350"))
+    assert preview.size == (350, 250)
+
+
+def test_unknown_routes_and_jobs_are_not_found(served):
+    client, _, _ = served
+    with pytest.raises(RuntimeError, match="404"):
+        client.get("/nothing")
+    with pytest.raises(RuntimeError, match="404"):
+        client.get("/jobs/7")
+
+
+@pytest.mark.parametrize("path", ["/crop?x=0", "/crop?x=0&y=0&w=10&h=ten", "/preview?width=wide", "/jobs/seven"])
+def test_bad_parameters_are_bad_requests(served, path):
+    client, _, _ = served
+    with pytest.raises(RuntimeError, match="400"):
+        client.get(path)
+
+
+def test_faults_in_the_service_are_server_errors(served):
+    client, poster_service, _ = served
+    poster_service.status = lambda: 1 / 0
+    with pytest.raises(RuntimeError, match="500 ZeroDivisionError"):
+        client.get("/status")
+
+
+def test_cover_overwritten_in_place_is_redrawn(served):
+    client, poster_service, base_dir = served
+    placement = poster_service.placement
+    aid = max(placement.placements, key=lambda a: placement.placement_size[a])
+    x_row, y_row = placement.placements[aid]
+    dim = poster_service.settings.dim
+    x = x_row * dim + int(poster_service.settings.right_margin_px / 2)
+    y = y_row * dim + int(poster_service.settings.bottom_margin_px / 2)
+    crop = f"/crop?x={x}&y={y}&w={dim}&h={dim}"
+    before = png(client.get(crop)).getpixel((dim // 2, dim // 2))
+
+    # Overwriting a file doesn't change its directory's mtime, which is put back to be sure
+    dir_stat = os.stat(base_dir)
+    colour = tuple(255 - c for c in before)
+    cover_file = os.path.join(base_dir, f"{aid}.png")
+    Image.new("RGB", (64, 64), colour).save(cover_file)
+    cover_mtime = os.stat(cover_file).st_mtime_ns + 10 ** 9
+    os.utime(cover_file, ns=(cover_mtime, cover_mtime))
+    os.utime(base_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+    assert png(client.get(crop)).getpixel((dim // 2, dim // 2)) == colour
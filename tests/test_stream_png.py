@@ -0,0 +1,66 @@
+import struct
+import zlib
+
+import pytest
+from PIL import Image, ImageChops
+
+import stream_png
+
+WIDTH = 53
+HEIGHT = 70
+
+
+def picture():
+    noise = Image.effect_noise((WIDTH, HEIGHT), 80).convert("RGB")
+    return ImageChops.multiply(noise, Image.linear_gradient("L").resize((WIDTH, HEIGHT)).convert("RGB"))
+
+
+def chunks(file):
+    with open(file, "rb") as f:
+        data = f.read()
+    assert data.startswith(stream_png.PNG_SIGNATURE)
+
+    offset = len(stream_png.PNG_SIGNATURE)
+    found = []
+    while offset < len(data):
+        length, = struct.unpack_from(">I", data, offset)
+        chunk_type = data[offset + 4:offset + 8]
+        body = data[offset + 8:offset + 8 + length]
+        crc, = struct.unpack_from(">I", data, offset + 8 + length)
+        assert crc == zlib.crc32(body, zlib.crc32(chunk_type))
+        found.append((chunk_type, body))
+        offset += 12 + length
+    return found
+
+
+def write(file, image, strip_height, compress_level, processes):
+    with stream_png.png_writer(file, image.width, image.height, compress_level, processes) as writer:
+        for y in range(0, image.height, strip_height):
+            writer.write_strip(image.crop((0, y, image.width, min(y + strip_height, image.height))))
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+@pytest.mark.parametrize("strip_height", [1, 16, HEIGHT])
+@pytest.mark.parametrize("compress_level", [0, 1, 6, 9])
+def test_png_writer_output_decodes_to_the_image(tmp_path, processes, strip_height, compress_level):
+    image = picture()
+    file = str(tmp_path / "out.png")
+    write(file, image, strip_height, compress_level, processes)
+
+    found = chunks(file)
+    assert [chunk_type for chunk_type, _ in found][0] == b"IHDR" and found[-1][0] == b"IEND"
+    # zlib.decompress checks the combined Adler-32 as well as the deflate stream
+    raw = zlib.decompress(b"".join(body for chunk_type, body in found if chunk_type == b"IDAT"))
+    stride = WIDTH * 3
+    assert raw == b"".join(b"\x00" + image.tobytes()[y * stride:(y + 1) * stride] for y in range(HEIGHT))
+
+    with Image.open(file) as decoded:
+        assert decoded.tobytes() == image.tobytes()
+
+
+def test_adler32_combine_matches_zlib():
+    first = bytes(range(256)) * 300
+    second = b"poster" * 12345
+    combined = stream_png.adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+    assert combined == zlib.adler32(first + second)
+    assert stream_png.adler32_combine(1, zlib.adler32(second), len(second)) == zlib.adler32(second)
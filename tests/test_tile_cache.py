@@ -0,0 +1,39 @@
+import os
+import pickle
+
+from PIL import Image
+
+import tile_cache
+
+
+def test_pickled_cache_is_read_from_disk_once_per_process(tmp_path, monkeypatch):
+    directory = str(tmp_path / "tiles")
+    cache = tile_cache.TileCache(directory, max_bytes=10 ** 6)
+    cache.put("a" * 40, Image.new("RGB", (4, 4), "red"))
+
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda path: listed.append(path) or listdir(path))
+
+    data = pickle.dumps(cache)
+    assert len(data) < 200
+    first = pickle.loads(data)
+    second = pickle.loads(pickle.dumps(cache))
+    assert first is second and listed == []
+
+    assert first.get("a" * 40, 4).getpixel((0, 0)) == (255, 0, 0)
+    assert second.get("b" * 40, 4) is None
+    assert listed == [directory]
+
+
+def test_lowered_cap_evicts_oldest_tiles(tmp_path):
+    directory = str(tmp_path / "tiles")
+    cache = tile_cache.TileCache(directory)
+    for i, key in enumerate("abc"):
+        cache.put(key * 40, Image.new("RGB", (4, 4), "red"))
+        os.utime(os.path.join(directory, f"{key * 40}.rgb"), (i, i))
+
+    smaller = tile_cache.TileCache(directory, max_bytes=2 * 4 * 4 * 3)
+    assert smaller.get("a" * 40, 4) is None
+    assert smaller.get("c" * 40, 4) is not None
+    assert sorted(os.listdir(directory)) == [f"{key * 40}.rgb" for key in "bc"]
@@ -0,0 +1,123 @@
+from PIL import Image
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+
+# On-disk cache of resized artwork, so re-rendering a layout skips decoding and resampling.
+# Entries are raw RGB bytes named by a hash of everything that affects the resized pixels:
+# album id, source file mtime and size, target size in px and the resampling filter.
+# Least recently used entries are removed once the cache grows past max_bytes
+class TileCache:
+
+    def __init__(self, directory: str, max_bytes=2 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # Guards entries when render threads share the cache
+        os.makedirs(directory, exist_ok=True)
+
+        # File name -> size in bytes, oldest use first. Read from disk on first use
+        self.entries = None
+        self.total_bytes = 0
+
+    def _load_index(self):
+        # Callers hold the lock
+        if self.entries is not None:
+            return
+
+        self.entries = OrderedDict()
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".rgb"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+
+        # The cap may have been lowered since the cache was last used
+        self.evict()
+
+    # Only the directory and cap are sent to worker processes. Every job unpickles to the same cache in a worker,
+    # so its index is read from disk once per process rather than once per band
+    def __reduce__(self):
+        return worker_cache, (self.directory, self.max_bytes)
+
+    def key(self, aid: str, source: str, px: int, resample) -> str:
+        stat = os.stat(source)
+        parts = f"{aid}|{stat.st_mtime_ns}|{stat.st_size}|{px}|{resample}"
+        return hashlib.sha1(parts.encode("utf-8")).hexdigest()
+
+    def _path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def get(self, key: str, px: int):
+        name = f"{key}.rgb"
+        with self.lock:
+            self._load_index()
+            if name not in self.entries:
+                self.misses += 1
+                return None
+
+        try:
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            # Evicted by another process or thread
+            with self.lock:
+                if name in self.entries:
+                    self.total_bytes -= self.entries.pop(name)
+                self.misses += 1
+            return None
+
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+            self.hits += 1
+        return Image.frombytes("RGB", (px, px), data)
+
+    def put(self, key: str, image: Image):
+        assert image.mode == "RGB"
+        name = f"{key}.rgb"
+        data = image.tobytes()
+
+        # Write then rename so other processes never read a half written tile
+        tmp_path = self._path(f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(name))
+
+        with self.lock:
+            self._load_index()
+            if name in self.entries:
+                self.total_bytes -= self.entries.pop(name)
+            self.entries[name] = len(data)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def evict(self):
+        # Callers hold the lock
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+
+_worker_caches = {}
+_worker_caches_lock = threading.Lock()
+
+
+def worker_cache(directory: str, max_bytes: int) -> TileCache:
+    with _worker_caches_lock:
+        key = (directory, max_bytes)
+        if key not in _worker_caches:
+            _worker_caches[key] = TileCache(directory, max_bytes)
+        return _worker_caches[key]